@@ -0,0 +1,424 @@
+####################################
+# ProtoCSS Package Manager Benchmarks #
+####################################
+import argparse
+import hashlib
+import http.server
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from colorama import Fore, Style
+
+PTM_DIR = os.path.dirname(os.path.abspath(__file__))
+PTM_SCRIPT = os.path.join(PTM_DIR, "ptm.py")
+
+# Modules that only cloud commands may load.
+CLOUD_MODULES = ("firebase_admin", "google.cloud", "requests", "tqdm")
+
+
+def _import_profile(cwd):
+    # `python -X importtime` reports, per module, the self and cumulative import time in microseconds.
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import ptm"], cwd=cwd,
+                            env=dict(os.environ, PYTHONPATH=PTM_DIR), capture_output=True, text=True, check=True)
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = line[len("import time:"):].split("|")
+        if not fields[1].strip().isdigit():
+            continue
+        modules[fields[2].strip()] = int(fields[1])
+    return modules
+
+
+def _run_local_command(cwd, runs):
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, PTM_SCRIPT, "-gi", "math"], cwd=cwd, capture_output=True, check=True)
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+def startup(args):
+    # Runs in an empty project without .env, like a fresh checkout running a local-only command.
+    with tempfile.TemporaryDirectory() as cwd:
+        os.makedirs(os.path.join(cwd, "modules", "math"))
+        with open(os.path.join(cwd, "modules", "math", "package.json"), "w") as file:
+            file.write('{"name": "math", "description": "d", "author": "a", "version": "1.0.0"}')
+
+        modules = _import_profile(cwd)
+        import_ms = modules.get("ptm", 0) / 1000
+        cloud_modules = sorted(name for name in modules if name.split(".")[0] in CLOUD_MODULES
+                               or name.startswith(CLOUD_MODULES))
+        timings = _run_local_command(cwd, args.runs)
+
+    command_ms = statistics.median(timings)
+    print(f"{Fore.LIGHTWHITE_EX}import ptm:{Style.RESET_ALL} {import_ms:.1f} ms (budget {args.import_budget} ms)")
+    print(f"{Fore.LIGHTWHITE_EX}ptm -gi (median of {args.runs}):{Style.RESET_ALL} {command_ms:.1f} ms "
+          f"(budget {args.command_budget} ms)")
+
+    failed = False
+    if cloud_modules:
+        print(f"{Fore.RED}Cloud modules imported at startup: {', '.join(cloud_modules[:10])}{Style.RESET_ALL}")
+        failed = True
+    if import_ms > args.import_budget:
+        print(f"{Fore.RED}Import time is over budget.{Style.RESET_ALL}")
+        failed = True
+    if command_ms > args.command_budget:
+        print(f"{Fore.RED}Local command time is over budget.{Style.RESET_ALL}")
+        failed = True
+    if not failed:
+        print(f"{Fore.LIGHTGREEN_EX}Startup is within budget.{Style.RESET_ALL}")
+    return not failed
+
+
+class FaultyHandler(http.server.SimpleHTTPRequestHandler):
+    # Serves files with Range support, and misbehaves on purpose: with probability `drop_rate` a response is cut off
+    # part-way (or answered with a 503), and every 64 KiB block is delayed by `delay` seconds.
+    drop_rate = 0.0
+    delay = 0.0
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        if random.random() < self.drop_rate / 4:
+            self.send_error(503)
+            return
+        size = os.path.getsize(path)
+        begin, end = 0, size
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match:
+            begin = int(match.group(1))
+            end = int(match.group(2)) + 1 if match.group(2) else size
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {begin}-{end - 1}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(end - begin))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+
+        cut_at = begin + random.randint(0, end - begin) if random.random() < self.drop_rate else None
+        with open(path, "rb") as file:
+            file.seek(begin)
+            position = begin
+            while position < end:
+                block = file.read(min(64 * 1024, end - position))
+                if cut_at is not None and position + len(block) > cut_at:
+                    self.wfile.write(block[:cut_at - position])
+                    self.close_connection = True
+                    return
+                if self.delay:
+                    time.sleep(self.delay)
+                self.wfile.write(block)
+                position += len(block)
+
+
+def serve(root, drop_rate=0.0, delay=0.0):
+    handler = type("Handler", (FaultyHandler,), {"drop_rate": drop_rate, "delay": delay})
+    server = http.server.ThreadingHTTPServer(
+        ("127.0.0.1", 0), lambda *args: handler(*args, directory=root))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def download(args):
+    # Exercises the downloader against the faulty stand-in server, both as one resumable stream and as parallel
+    # ranged segments, and checks that every byte arrives intact.
+    sys.path.insert(0, PTM_DIR)
+    import ptm
+
+    size = ptm._parse_size(args.size)
+    ok = True
+    with tempfile.TemporaryDirectory() as root:
+        payload = os.urandom(size)
+        expected = hashlib.sha256(payload).hexdigest()
+        with open(os.path.join(root, "package.ptm"), "wb") as file:
+            file.write(payload)
+        server, url = serve(root, args.drop_rate, args.delay)
+        try:
+            for mode in ("stream", "segments"):
+                downloader = ptm._Downloader(retries=args.retries, backoff=0.01, connections=args.connections)
+                started = time.perf_counter()
+                if mode == "stream":
+                    digest = hashlib.sha256()
+                    downloader.stream(f"{url}/package.ptm", digest.update)
+                    actual = digest.hexdigest()
+                else:
+                    target = os.path.join(root, "download.part")
+                    downloader.fetch_segments(f"{url}/package.ptm", target, size, lambda n: None)
+                    actual = ptm._sha256_file(target)
+                elapsed = time.perf_counter() - started
+                status = f"{Fore.LIGHTGREEN_EX}OK{Style.RESET_ALL}" if actual == expected else \
+                    f"{Fore.RED}HASH MISMATCH{Style.RESET_ALL}"
+                ok = ok and actual == expected
+                print(f"{Fore.LIGHTWHITE_EX}{mode}:{Style.RESET_ALL} {status}  {size / elapsed / 1024 ** 2:.1f} MiB/s  "
+                      f"{downloader.retries_used} retries")
+        finally:
+            server.shutdown()
+    return ok
+
+
+# Synthetic package profiles: (file count, total size, content). Text files look like `ptm_package/math.ptcss`;
+# binary files are incompressible, like the images and fonts in an asset pack.
+PROFILES = {
+    "tiny": (1, 2 * 1024, "text"),
+    "small": (40, 256 * 1024, "text"),
+    "medium": (400, 16 * 1024 ** 2, "mixed"),
+    "large": (24, 256 * 1024 ** 2, "binary"),
+}
+
+
+def _ptcss(rng, size):
+    rules = []
+    length = 0
+    while length < size:
+        name = "".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(3, 10)))
+        rule = f"@math {name}(a, b) {{\n  @return ((a * {rng.randint(1, 99)}) + b);\n}}\n\n"
+        rules.append(rule)
+        length += len(rule)
+    return "".join(rules)[:size].encode()
+
+
+def _make_package(source_dir, name, profile, seed):
+    file_count, total_size, content = PROFILES[profile]
+    rng = random.Random(seed)
+    os.makedirs(source_dir)
+    for index in range(file_count):
+        size = total_size // file_count
+        binary = content == "binary" or content == "mixed" and index % 2
+        path = os.path.join(source_dir, "assets" if binary else "styles", f"{index:04d}.{'bin' if binary else 'ptcss'}")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as file:
+            # Written in blocks so generating an asset pack doesn't inflate this process (and the RSS its children
+            # inherit at fork).
+            for offset in range(0, size, 1024 ** 2):
+                block = min(1024 ** 2, size - offset)
+                file.write(rng.randbytes(block) if binary else _ptcss(rng, block))
+    with open(os.path.join(source_dir, "package.json"), "w") as file:
+        json.dump({"name": name, "version": "1.0.0", "description": f"Benchmark package ({profile})",
+                   "author": "bench"}, file)
+
+
+def _snapshot(*roots):
+    files = {}
+    for root in roots:
+        for directory, _, names in os.walk(root):
+            for name in names:
+                path = os.path.join(directory, name)
+                try:
+                    files[path] = os.stat(path).st_mtime_ns
+                except FileNotFoundError:
+                    pass
+    return files
+
+
+def _run_ptm(arguments, cwd, env, watched):
+    # Runs one ptm command in a child process and returns (seconds, peak RSS in bytes, files written). wait4 gives
+    # the child's own rusage, so peak RSS covers exactly this command.
+    before = _snapshot(*watched)
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, PTM_SCRIPT, *arguments], cwd=cwd, env=env, stdin=subprocess.DEVNULL,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    stderr = process.stderr.read()
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - started
+    process.stderr.close()
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode:
+        raise RuntimeError(f"ptm {' '.join(arguments)} failed:\n{stderr.decode(errors='replace')}")
+    after = _snapshot(*watched)
+    written = sum(1 for path, mtime in after.items() if before.get(path) != mtime)
+    peak_rss = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+    return elapsed, peak_rss, written
+
+
+def _percentile(values, percent):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, -(-len(ordered) * percent // 100) - 1))]
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class _Suite:
+    def __init__(self, root, transport, runs, compression):
+        self.root = root
+        self.runs = runs
+        self.compression = compression
+        self.registry_dir = os.path.join(root, "registry")
+        self.cache_dir = os.path.join(root, "cache")
+        self.env = dict(os.environ, PTM_CACHE_DIR=self.cache_dir, PTM_CACHE_SIZE="4G", PTM_INDEX_TTL="0",
+                        PYTHONPATH=PTM_DIR)
+        self.env.pop("PTM_REGISTRY_TOKEN", None)
+        self.server = None
+        self.registry = self.registry_dir
+        if transport == "http":
+            port = _free_port()
+            self.server = subprocess.Popen([sys.executable, PTM_SCRIPT, "serve-registry", self.registry_dir,
+                                            "--port", str(port)], env=self.env, stdout=subprocess.DEVNULL,
+                                           stderr=subprocess.DEVNULL)
+            self.registry = f"http://127.0.0.1:{port}"
+            for _ in range(100):
+                try:
+                    socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+                    break
+                except OSError:
+                    time.sleep(0.05)
+        self.results = []
+
+    def close(self):
+        if self.server is not None:
+            self.server.terminate()
+            self.server.wait()
+
+    def measure(self, profile, scenario, names, size, arguments, prepare=None, cwd=None):
+        timings, peaks, written = [], [], []
+        for _ in range(self.runs):
+            project = cwd or tempfile.mkdtemp(dir=self.root, prefix="project-")
+            if prepare is not None:
+                prepare()
+            elapsed, peak_rss, files = _run_ptm(["--registry", self.registry, *arguments], project, self.env,
+                                                [project, self.cache_dir, self.registry_dir])
+            timings.append(elapsed)
+            peaks.append(peak_rss)
+            written.append(files)
+            if cwd is None:
+                shutil.rmtree(project)
+        median = statistics.median(timings)
+        result = {
+            "profile": profile, "scenario": scenario, "packages": len(names), "bytes": size, "runs": self.runs,
+            "p50_ms": round(median * 1000, 2), "p95_ms": round(_percentile(timings, 95) * 1000, 2),
+            "mean_ms": round(statistics.mean(timings) * 1000, 2),
+            "throughput_mib_s": round(size / median / 1024 ** 2, 2) if size else None,
+            "peak_rss_mib": round(max(peaks) / 1024 ** 2, 1), "files_written": max(written),
+        }
+        self.results.append(result)
+        throughput = f"{result['throughput_mib_s']:>8.1f} MiB/s" if size else f"{'':>14}"
+        print(f"{Fore.LIGHTWHITE_EX}{profile:<7} {scenario:<18}{Style.RESET_ALL} {len(names):>3} pkg  "
+              f"p50 {result['p50_ms']:>9.1f} ms  p95 {result['p95_ms']:>9.1f} ms  {throughput}  "
+              f"{result['peak_rss_mib']:>6.1f} MiB RSS  {result['files_written']:>5} files")
+
+    def run_profile(self, profile, count):
+        # Uploads `count` synthetic packages from one project, then times uploads (fresh and unchanged), installs
+        # of 1 and `count` packages with a cold and a warm cache, and metadata lookups.
+        source = os.path.join(self.root, f"source-{profile}")
+        names = [f"bench-{profile}-{index}" for index in range(count)]
+        for index, name in enumerate(names):
+            _make_package(os.path.join(source, "ptm_package", name), name, profile, seed=index)
+        source_size = sum(os.path.getsize(os.path.join(directory, name)) for directory, _, files in
+                          os.walk(os.path.join(source, "ptm_package")) for name in files)
+
+        def clear_registry():
+            shutil.rmtree(os.path.join(self.registry_dir, "packages"), ignore_errors=True)
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+        def clear_cache():
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+        upload = ["-up", *names, "--compression", self.compression]
+        self.measure(profile, "upload", names, source_size, upload, clear_registry, cwd=source)
+        self.measure(profile, "upload-unchanged", names, 0, upload, cwd=source)
+
+        with open(os.path.join(self.registry_dir, "packages", "index.json")) as file:
+            releases = json.load(file)["packages"]
+        archive_sizes = {name: releases[name]["versions"]["1.0.0"]["size"] for name in names}
+        for group in ([names[0]], names) if count > 1 else ([names[0]],):
+            size = sum(archive_sizes[name] for name in group)
+            suffix = "1" if len(group) == 1 else "n"
+            self.measure(profile, f"install-cold-{suffix}", group, size, ["-i", *group], clear_cache)
+            self.measure(profile, f"install-warm-{suffix}", group, size, ["-i", *group])
+        self.measure(profile, "info", names, 0, ["-gic", *names])
+        shutil.rmtree(source)
+
+
+def suite(args):
+    # Runs the install, upload and metadata paths end to end through the ptm CLI, against a registry in a temporary
+    # directory (served over HTTP with `ptm serve-registry` for `--transport http`). Nothing touches the network.
+    profiles = args.profiles.split(",")
+    unknown = sorted(set(profiles) - set(PROFILES))
+    if unknown:
+        print(f"{Fore.RED}Unknown profiles: {', '.join(unknown)}{Style.RESET_ALL}")
+        return False
+    with tempfile.TemporaryDirectory(prefix="ptm-bench-") as root:
+        bench = _Suite(root, args.transport, args.runs, args.compression)
+        try:
+            for profile in profiles:
+                bench.run_profile(profile, args.count)
+        finally:
+            bench.close()
+
+    report = {
+        "version": 1,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "transport": args.transport,
+        "compression": args.compression,
+        "runs": args.runs,
+        "results": bench.results,
+    }
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=4)
+    print(f"{Fore.LIGHTGREEN_EX}Results written to {args.output}{Style.RESET_ALL}")
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="bench", description="ProtoCSS Package Manager benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    startup_parser = commands.add_parser("startup", help="Check cold start time of local commands")
+    startup_parser.add_argument("--runs", type=int, default=5)
+    startup_parser.add_argument("--import-budget", type=float, default=50, help="Budget for `import ptm` in ms")
+    startup_parser.add_argument("--command-budget", type=float, default=250, help="Budget for `ptm -gi` in ms")
+    startup_parser.set_defaults(run=startup)
+
+    download_parser = commands.add_parser("download", help="Download through a server that drops connections")
+    download_parser.add_argument("--size", default="32M")
+    download_parser.add_argument("--drop-rate", type=float, default=0.3, help="Share of responses cut off part-way")
+    download_parser.add_argument("--delay", type=float, default=0.0, help="Seconds of delay per 64 KiB block")
+    download_parser.add_argument("--connections", type=int, default=4)
+    download_parser.add_argument("--retries", type=int, default=20)
+    download_parser.set_defaults(run=download)
+
+    suite_parser = commands.add_parser("suite", help="Time install, upload and metadata commands offline")
+    suite_parser.add_argument("--profiles", default=",".join(PROFILES),
+                              help=f"Package profiles to run (default: {','.join(PROFILES)})")
+    suite_parser.add_argument("--count", type=int, default=4, help="Number of packages for the N-package runs")
+    suite_parser.add_argument("--runs", type=int, default=3, help="Runs per scenario")
+    suite_parser.add_argument("--transport", choices=("local", "http"), default="http",
+                              help="Read the registry directory directly, or through `ptm serve-registry`")
+    suite_parser.add_argument("--compression", choices=("zip", "zlib", "xz", "zstd"), default="zip",
+                              help="Package format to upload the synthetic packages in")
+    suite_parser.add_argument("--output", default="bench-results.json", help="JSON file for the results")
+    suite_parser.set_defaults(run=suite)
+
+    args = parser.parse_args()
+    if not args.run(args):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,36 +1,2129 @@
 ############################
 # ProtoCSS Package Manager #
 ############################
+import collections
+import contextlib
+import contextvars
+import copy
+import fnmatch
+import hashlib
 import json
-from tqdm import tqdm
-import requests
+import sys
+import threading
+import time
 import os
+import random
+import re
 import shutil
 import argparse
+import bz2
+import struct
+import tempfile
+import zipfile
+import zlib
 from colorama import Back, Fore, Style
-import firebase_admin
-from firebase_admin import credentials, storage
 import datetime
 
-with open(".env") as file:
-    for line in file:
-        if line.startswith("CERT_PATH"):
-            __cert_path__ = line.split("=")[1].replace("\n", "").strip('"').strip("'")
-        elif line.startswith("STORAGE_BUCKET"):
-            __storage_bucket__ = line.split("=")[1].strip('"').replace("\n", "").strip('"').strip("'")
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
-cred = credentials.Certificate(__cert_path__)
-options = {
-    'storageBucket': __storage_bucket__
-}
-firebase_admin.initialize_app(cred, options)
+# `.env`, the Firebase SDK, requests and tqdm are only loaded by the commands that need them, so local
+# commands such as `ptm -gi` start quickly and work without cloud credentials.
+_config_values = None
+_RESUMABLE_UPLOAD_THRESHOLD = 8 * 1024 * 1024
+_firebase_lock = threading.Lock()
+_firebase_ready = False
+# The client of the `ptm daemon` request being served in this context; None outside the daemon.
+_output = contextvars.ContextVar("ptm_output", default=None)
+
+
+def _load_config():
+    global _config_values
+    if _config_values is None:
+        values = {}
+        if os.path.exists(".env"):
+            with open(".env") as file:
+                for line in file:
+                    if "=" in line:
+                        key, value = line.split("=", 1)
+                        values[key.strip()] = value.strip().strip('"').strip("'")
+        _config_values = values
+    return _config_values
+
+
+def _bucket():
+    global _firebase_ready
+    import firebase_admin
+    from firebase_admin import credentials, storage
+
+    with _firebase_lock:
+        if not _firebase_ready:
+            cert_path = _config("CERT_PATH")
+            storage_bucket = _config("STORAGE_BUCKET")
+            if not cert_path or not storage_bucket:
+                raise RuntimeError("CERT_PATH and STORAGE_BUCKET must be set in .env to reach the package registry.")
+            cred = credentials.Certificate(cert_path)
+            options = {
+                'storageBucket': storage_bucket
+            }
+            firebase_admin.initialize_app(cred, options)
+            _firebase_ready = True
+    return storage.bucket()
+
+
+def _config(key, default=None):
+    return os.environ.get(f"PTM_{key}", _load_config().get(key, default))
+
+
+def _parse_size(value):
+    value = str(value).strip().upper().rstrip("B")
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def _sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+@contextlib.contextmanager
+def _claim_file(path):
+    # Opens `path` for reading and appending under an exclusive lock. If another process holds it (two parallel
+    # builds downloading the same archive), a private file next to it is used instead.
+    file = open(path, "a+b")
+    if fcntl is not None:
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            file.close()
+            path = f"{path}.{os.getpid()}.{threading.get_ident()}"
+            file = open(path, "a+b")
+    try:
+        yield path, file
+    finally:
+        file.close()
+
+
+def _write_json_atomic(path, data):
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, "w") as file:
+        json.dump(data, file, indent=4, sort_keys=True)
+    os.replace(temp_path, path)
+
+
+def _thread_pool(max_workers):
+    # Workers start with the submitting thread's output, so inside `ptm daemon` they print to the same client.
+    import concurrent.futures
+
+    return concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, initializer=_output.set,
+                                                 initargs=(_output.get(),))
+
+
+class StorageNotFound(LookupError):
+    pass
+
+
+class StorageConflict(Exception):
+    pass
+
+
+class StorageBackend:
+    # Where packages live. Paths are registry-relative (`packages/<name>/<version>/...`). `tag` values are opaque
+    # version markers (a GCS generation, an ETag): `read` returns `(None, tag)` when the object still matches
+    # `if_none_match`, and `write` raises StorageConflict unless the object still matches `if_match` (`""` means
+    # "must not exist yet").
+    def read(self, path, if_none_match=None):
+        raise NotImplementedError
+
+    def write(self, path, data, content_type="application/octet-stream", metadata=None, if_match=None):
+        raise NotImplementedError
+
+    def upload_file(self, path, file_path, metadata=None):
+        with open(file_path, "rb") as file:
+            self.write(path, file.read(), metadata=metadata)
+
+    def metadata(self, path):
+        raise NotImplementedError
+
+    def url(self, path):
+        raise NotImplementedError
+
+    def download_headers(self):
+        # Headers that downloads of `url()` need, e.g. credentials; signed and file URLs need none.
+        return {}
+
+
+class FirebaseBackend(StorageBackend):
+    def read(self, path, if_none_match=None):
+        from google.api_core import exceptions
+
+        blob = _bucket().blob(path)
+        try:
+            if if_none_match:
+                data = blob.download_as_bytes(if_generation_not_match=int(if_none_match))
+            else:
+                data = blob.download_as_bytes()
+        except exceptions.NotModified:
+            return None, if_none_match
+        except exceptions.NotFound:
+            raise StorageNotFound(path)
+        return data, str(blob.generation)
+
+    def write(self, path, data, content_type="application/octet-stream", metadata=None, if_match=None):
+        from google.api_core import exceptions
+
+        blob = _bucket().blob(path)
+        blob.metadata = metadata
+        try:
+            blob.upload_from_string(data, content_type=content_type,
+                                    if_generation_match=None if if_match is None else int(if_match or 0))
+        except exceptions.PreconditionFailed:
+            raise StorageConflict(path)
+
+    def upload_file(self, path, file_path, metadata=None):
+        blob = _bucket().blob(path)
+        blob.metadata = metadata
+        if os.path.getsize(file_path) > _RESUMABLE_UPLOAD_THRESHOLD:
+            # A chunk size makes the client use a resumable upload that retries failed chunks instead of the archive.
+            blob.chunk_size = _RESUMABLE_UPLOAD_THRESHOLD
+        blob.upload_from_filename(file_path)
+
+    def metadata(self, path):
+        from google.api_core import exceptions
+
+        blob = _bucket().blob(path)
+        try:
+            blob.reload()
+        except exceptions.NotFound:
+            return None
+        return blob.metadata or {}
+
+    def url(self, path):
+        return _bucket().blob(path).generate_signed_url(datetime.timedelta(minutes=5))
+
+
+class LocalBackend(StorageBackend):
+    # A registry in a plain directory (a network share, a CI artifact directory, or the root served by
+    # `ptm serve-registry`). Object metadata lives in `<path>.meta.json` sidecars.
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self._lock = threading.Lock()
+
+    def _path(self, path):
+        # Registry paths may not leave the root; ValueError otherwise.
+        return os.path.join(self.root, *_relative_parts(path))
+
+    def tag(self, path):
+        try:
+            stat = os.stat(self._path(path))
+        except FileNotFoundError:
+            return None
+        return f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+    def read(self, path, if_none_match=None):
+        tag = self.tag(path)
+        if tag is None:
+            raise StorageNotFound(path)
+        if if_none_match == tag:
+            return None, tag
+        with open(self._path(path), "rb") as file:
+            return file.read(), tag
+
+    def write(self, path, data, content_type="application/octet-stream", metadata=None, if_match=None):
+        target = self._path(path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with _locked_file(os.path.join(self.root, ".lock"), self._lock):
+            if if_match is not None and (self.tag(path) or "") != if_match:
+                raise StorageConflict(path)
+            temp_path = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_path, "wb") as file:
+                file.write(data if isinstance(data, bytes) else data.encode())
+            if metadata is not None:
+                _write_json_atomic(f"{target}.meta.json", metadata)
+            os.replace(temp_path, target)
+
+    def upload_file(self, path, file_path, metadata=None):
+        target = self._path(path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        temp_path = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+        shutil.copyfile(file_path, temp_path)
+        if metadata is not None:
+            _write_json_atomic(f"{target}.meta.json", metadata)
+        os.replace(temp_path, target)
+
+    def metadata(self, path):
+        if self.tag(path) is None:
+            return None
+        try:
+            with open(f"{self._path(path)}.meta.json") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def url(self, path):
+        import pathlib
+
+        return pathlib.Path(self._path(path)).as_uri()
+
+
+class HTTPBackend(StorageBackend):
+    # A registry behind plain HTTP, such as `ptm serve-registry` or any static file server for read-only mirrors.
+    # Conditional requests use ETags; metadata travels in `X-Ptm-Meta-*` headers.
+    def __init__(self, base_url, token=None):
+        self.base_url = base_url.rstrip("/")
+        self.token = token if token is not None else _config("REGISTRY_TOKEN")
+        self._session_value = None
+
+    @property
+    def _session(self):
+        if self._session_value is None:
+            import requests
+
+            self._session_value = requests.Session()
+        return self._session_value
+
+    def _headers(self, headers=None):
+        headers = dict(headers or {})
+        if self.token:
+            headers["Authorization"] = f"Bearer {self.token}"
+        return headers
+
+    def read(self, path, if_none_match=None):
+        headers = {"If-None-Match": if_none_match} if if_none_match else {}
+        response = self._session.get(self.url(path), headers=self._headers(headers), timeout=30)
+        if response.status_code == 304:
+            return None, if_none_match
+        if response.status_code == 404:
+            raise StorageNotFound(path)
+        response.raise_for_status()
+        return response.content, response.headers.get("ETag")
+
+    def write(self, path, data, content_type="application/octet-stream", metadata=None, if_match=None):
+        headers = {"Content-Type": content_type}
+        headers.update({f"X-Ptm-Meta-{key}": str(value) for key, value in (metadata or {}).items()})
+        if if_match == "":
+            headers["If-None-Match"] = "*"
+        elif if_match is not None:
+            headers["If-Match"] = if_match
+        response = self._session.put(self.url(path), data=data, headers=self._headers(headers), timeout=300)
+        if response.status_code == 412:
+            raise StorageConflict(path)
+        response.raise_for_status()
+
+    def upload_file(self, path, file_path, metadata=None):
+        with open(file_path, "rb") as file:
+            self.write(path, file, metadata=metadata)
+
+    def metadata(self, path):
+        response = self._session.head(self.url(path), headers=self._headers(), timeout=30)
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        prefix = "x-ptm-meta-"
+        return {key[len(prefix):]: value for key, value in response.headers.items() if key.lower().startswith(prefix)}
+
+    def url(self, path):
+        return f"{self.base_url}/{path}"
+
+    def download_headers(self):
+        return self._headers()
+
+
+def _storage_backend(server_url=None):
+    # STORAGE_BACKEND picks the backend explicitly; otherwise an http(s) registry URL means HTTPBackend, any other
+    # URL or path means LocalBackend, and no registry at all means the Firebase bucket from .env.
+    server_url = server_url or _config("REGISTRY_URL", "")
+    backend = _config("STORAGE_BACKEND") or (
+        "http" if server_url.startswith(("http://", "https://")) else "local" if server_url else "firebase")
+    if backend == "firebase":
+        return FirebaseBackend()
+    if backend == "http":
+        return HTTPBackend(server_url)
+    if backend == "local":
+        if server_url.startswith("file://"):
+            import urllib.parse
+            import urllib.request
+
+            server_url = urllib.request.url2pathname(urllib.parse.urlparse(server_url).path)
+        return LocalBackend(server_url or "registry")
+    raise ValueError(f"Unknown storage backend '{backend}' (expected firebase, local or http).")
+
+
+class PackageCache:
+    # Shared on-disk store of downloaded archives. Archives are stored once per SHA-256 under `archives/`,
+    # `index.json` maps `name@version` to a hash, and the least recently used entries are evicted once the
+    # cache grows past `max_size` bytes.
+    def __init__(self, root=None, max_size=None):
+        self.root = root or _config("CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "ptm"))
+        self.max_size = _parse_size(max_size if max_size is not None else _config("CACHE_SIZE", "2G"))
+        self.archives_dir = os.path.join(self.root, "archives")
+        self.index_path = os.path.join(self.root, "index.json")
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def _locked(self):
+        os.makedirs(self.archives_dir, exist_ok=True)
+        return _locked_file(os.path.join(self.root, ".lock"), self._lock)
+
+    def _load(self):
+        try:
+            with open(self.index_path) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def archive_path(self, sha256):
+        return os.path.join(self.archives_dir, f"{sha256}.ptm")
+
+    def staging_path(self, package_file_name, sha256=None):
+        # Partial downloads of a known archive keep a stable name so a later run can resume them.
+        os.makedirs(self.archives_dir, exist_ok=True)
+        if sha256 is not None:
+            return os.path.join(self.archives_dir, f".{package_file_name}.{sha256[:16]}.part")
+        return os.path.join(self.archives_dir, f".{package_file_name}.{os.getpid()}.{threading.get_ident()}.part")
+
+    def get(self, package_name, package_version, sha256=None):
+        # A hit is returned as a claim (see _claim) that the caller removes once it has unpacked it.
+        key = f"{package_name}@{package_version}"
+        with self._locked():
+            index = self._load()
+            entry = index.get(key)
+            if entry is None or (sha256 is not None and entry["sha256"] != sha256):
+                return None
+            claim_path = self._claim(entry["sha256"])
+            if claim_path is not None:
+                entry["last_used"] = time.time()
+            _write_json_atomic(self.index_path, index)
+        # The archive is hashed outside the lock, so parallel installs and other processes don't queue behind it.
+        if claim_path is not None and _sha256_file(claim_path) == entry["sha256"]:
+            return claim_path
+        # Corrupt or missing archive: forget it so the caller downloads a fresh copy.
+        if claim_path is not None:
+            os.remove(claim_path)
+        with self._locked():
+            index = self._load()
+            if index.get(key, {}).get("sha256") == entry["sha256"]:
+                del index[key]
+                self._remove_unreferenced(index, entry["sha256"])
+                _write_json_atomic(self.index_path, index)
+        return None
+
+    def put(self, package_name, package_version, source_path, sha256=None, claim=False):
+        # With `claim`, returns a claim on the stored archive instead of its path.
+        sha256 = sha256 or _sha256_file(source_path)
+        size = os.path.getsize(source_path)
+        with self._locked():
+            index = self._load()
+            path = self.archive_path(sha256)
+            if os.path.exists(path):
+                os.remove(source_path)
+            else:
+                os.replace(source_path, path)
+            if claim:
+                path = self._claim(sha256)
+            index[f"{package_name}@{package_version}"] = {
+                "name": package_name,
+                "version": package_version,
+                "sha256": sha256,
+                "size": size,
+                "last_used": time.time(),
+            }
+            self._evict(index, self.max_size, keep=sha256)
+            _write_json_atomic(self.index_path, index)
+        return path
+
+    def _claim(self, sha256):
+        # Installs unpack an archive after their dependencies are in place, by which time a later `put` may have
+        # evicted it. A claim is a private hard link (a copy where links aren't supported) made under the lock, so
+        # eviction only drops the cache's name for the file. Returns None if the archive is missing.
+        path = os.path.join(self.archives_dir,
+                            f".{sha256}.{os.getpid()}.{threading.get_ident()}.{time.monotonic_ns()}.claim")
+        try:
+            os.link(self.archive_path(sha256), path)
+        except FileNotFoundError:
+            return None
+        except OSError:
+            shutil.copyfile(self.archive_path(sha256), path)
+        return path
+
+    def entries(self):
+        with self._locked():
+            return self._load()
+
+    def prune(self, max_size=None):
+        max_size = self.max_size if max_size is None else max_size
+        with self._locked():
+            index = self._load()
+            removed = self._evict(index, max_size)
+            referenced = {entry["sha256"] for entry in index.values()}
+            for file_name in os.listdir(self.archives_dir):
+                path = os.path.join(self.archives_dir, file_name)
+                if file_name.endswith(".ptm") and file_name[:-len(".ptm")] not in referenced:
+                    os.remove(path)
+                elif file_name.endswith(".claim"):
+                    # Claims share their archive's mtime, so only those of processes that are gone are dropped.
+                    if not _pid_alive(int(file_name.split(".")[2])):
+                        os.remove(path)
+                elif file_name.startswith(".") and time.time() - os.path.getmtime(path) > 24 * 3600:
+                    # Partial downloads nobody resumed within a day.
+                    os.remove(path)
+            _write_json_atomic(self.index_path, index)
+        return removed
+
+    def verify(self):
+        corrupt = []
+        with self._locked():
+            index = self._load()
+            for key, entry in list(index.items()):
+                path = self.archive_path(entry["sha256"])
+                if not os.path.exists(path) or _sha256_file(path) != entry["sha256"]:
+                    corrupt.append(key)
+                    del index[key]
+                    self._remove_unreferenced(index, entry["sha256"])
+            _write_json_atomic(self.index_path, index)
+        return corrupt
+
+    def _evict(self, index, max_size, keep=None):
+        # Archives shared by several entries are only counted (and deleted) once.
+        sizes = {entry["sha256"]: entry["size"] for entry in index.values()}
+        total = sum(sizes.values())
+        removed = []
+        for key, entry in sorted(index.items(), key=lambda item: item[1]["last_used"]):
+            if total <= max_size:
+                break
+            if entry["sha256"] == keep:
+                continue
+            del index[key]
+            removed.append(key)
+            if self._remove_unreferenced(index, entry["sha256"]):
+                total -= sizes[entry["sha256"]]
+        return removed
+
+    def _remove_unreferenced(self, index, sha256):
+        if any(entry["sha256"] == sha256 for entry in index.values()):
+            return False
+        if os.path.exists(self.archive_path(sha256)):
+            os.remove(self.archive_path(sha256))
+        return True
+
+
+@contextlib.contextmanager
+def _locked_file(lock_path, thread_lock):
+    # Serializes read-modify-write cycles between threads (`thread_lock`) and, where flock exists, processes.
+    with thread_lock, open(lock_path, "a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class InstalledState:
+    # `modules/.ptm-state`: one JSON document recording every installed package with its version, archive hash,
+    # package.json fields and the size, mtime and SHA-256 of each file. It is rewritten atomically after each
+    # install, so "is it installed", `-gi` and `ptm list` are a single read and `ptm verify` can spot drift from stat
+    # results alone before hashing anything.
+    def __init__(self, modules_dir):
+        self.modules_dir = modules_dir
+        self.path = os.path.join(modules_dir, ".ptm-state")
+        self._lock = threading.Lock()
+
+    def packages(self):
+        try:
+            with open(self.path) as file:
+                return json.load(file)["packages"]
+        except (OSError, ValueError, KeyError):
+            return {}
+
+    def get(self, package_name):
+        return self.packages().get(package_name)
+
+    def record(self, package_name, entry):
+        self._update(lambda packages: packages.__setitem__(package_name, entry))
+
+    def remove(self, package_name):
+        self._update(lambda packages: packages.pop(package_name, None))
+
+    def _update(self, change):
+        os.makedirs(self.modules_dir, exist_ok=True)
+        with _locked_file(os.path.join(self.modules_dir, ".ptm-state.lock"), self._lock):
+            packages = self.packages()
+            change(packages)
+            _write_json_atomic(self.path, {"version": 1, "packages": packages})
+
+    def verify(self, package_name):
+        # Returns (missing, modified, unexpected) file lists for one package.
+        entry = self.get(package_name)
+        package_dir = os.path.join(self.modules_dir, package_name)
+        missing, modified = [], []
+        for relative_path, recorded in entry["files"].items():
+            path = os.path.join(package_dir, *relative_path.split("/"))
+            try:
+                stat = os.stat(path)
+            except OSError:
+                missing.append(relative_path)
+                continue
+            if stat.st_size != recorded["size"]:
+                modified.append(relative_path)
+            elif stat.st_mtime_ns != recorded["mtime_ns"] and _sha256_file(path) != recorded["sha256"]:
+                modified.append(relative_path)
+        unexpected = []
+        for root, _, file_names in os.walk(package_dir):
+            for file_name in file_names:
+                relative_path = os.path.relpath(os.path.join(root, file_name), package_dir).replace(os.sep, "/")
+                if relative_path not in entry["files"]:
+                    unexpected.append(relative_path)
+        return missing, modified, sorted(unexpected)
+
+
+_SYMBOL_TOKENS = re.compile(rb'/\*.*?\*/|"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'|[{};]', re.S)
+_COMMENT = re.compile(rb"/\*.*?\*/", re.S)
+_MATH_DEFINITION = re.compile(rb"@math\s+([A-Za-z_][\w-]*)\s*\(")
+_RULE_CLASS = re.compile(rb"(?:^|,)\s*(\.-?[A-Za-z_][\w-]*)")
+
+
+def _scan_symbols(data):
+    # Returns [kind, name, byte offset] for the top-level definitions of one .ptcss file: `@math` functions, and the
+    # class that starts each selector of a rule (`.card` for `.card:hover, .card > .title { ... }`).
+    symbols = []
+    depth = 0
+    start = 0
+    for match in _SYMBOL_TOKENS.finditer(data):
+        token = match.group()
+        if token == b"{":
+            if depth == 0:
+                prelude = _COMMENT.sub(lambda comment: b" " * len(comment.group()), data[start:match.start()])
+                definition = _MATH_DEFINITION.search(prelude)
+                if definition is not None:
+                    symbols.append(["math", definition.group(1).decode(), start + definition.start()])
+                elif not prelude.lstrip().startswith(b"@"):
+                    names = set()
+                    for rule in _RULE_CLASS.finditer(prelude):
+                        if rule.group(1) not in names:
+                            names.add(rule.group(1))
+                            symbols.append(["rule", rule.group(1).decode(), start + rule.start(1)])
+            depth += 1
+        elif token == b"}":
+            depth = max(depth - 1, 0)
+            if depth == 0:
+                start = match.end()
+        elif token == b";" and depth == 0:
+            start = match.end()
+    return symbols
+
+
+class SymbolIndex:
+    # `modules/.ptm-symbols`: where each `@math` function and top-level rule class of the installed packages is
+    # defined (package, file, byte offset), so a compiler can resolve a name without walking `modules/`. `update`
+    # follows the installed state and only rescans .ptcss files whose hash changed.
+    def __init__(self, modules_dir):
+        self.modules_dir = modules_dir
+        self.path = os.path.join(modules_dir, ".ptm-symbols")
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.path) as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return {"version": 1, "packages": {}, "symbols": {}}
+        return data if data.get("version") == 1 else {"version": 1, "packages": {}, "symbols": {}}
+
+    def update(self, installed):
+        # `installed` is InstalledState.packages(). Returns the number of files scanned.
+        scanned = 0
+        with _locked_file(os.path.join(self.modules_dir, ".ptm-symbols.lock"), self._lock):
+            data = self._load()
+            packages = {}
+            for package_name, entry in installed.items():
+                previous = data["packages"].get(package_name, {})
+                files = {}
+                for relative_path, recorded in entry.get("files", {}).items():
+                    if not relative_path.endswith(".ptcss"):
+                        continue
+                    known = previous.get(relative_path)
+                    if known is not None and known["sha256"] == recorded["sha256"]:
+                        files[relative_path] = known
+                        continue
+                    try:
+                        with open(os.path.join(self.modules_dir, package_name, *relative_path.split("/")), "rb") as file:
+                            symbols = _scan_symbols(file.read())
+                    except OSError:
+                        continue
+                    files[relative_path] = {"sha256": recorded["sha256"], "symbols": symbols}
+                    scanned += 1
+                packages[package_name] = files
+            if scanned or packages.keys() != data["packages"].keys():
+                index = {}
+                for package_name, files in sorted(packages.items()):
+                    for relative_path, file_entry in sorted(files.items()):
+                        for kind, name, offset in file_entry["symbols"]:
+                            index.setdefault(name, []).append([package_name, relative_path, offset, kind])
+                os.makedirs(self.modules_dir, exist_ok=True)
+                _write_json_atomic(self.path, {"version": 1, "packages": packages, "symbols": index})
+        return scanned
+
+    def lookup(self, symbol):
+        # Returns every definition of `symbol` (`mult`, `.card`) as {"package", "file", "offset", "kind"}.
+        return [{"package": package_name, "file": relative_path, "offset": offset, "kind": kind}
+                for package_name, relative_path, offset, kind in self._load()["symbols"].get(symbol, [])]
+
+    def symbols(self):
+        return self._load()["symbols"]
+
+
+_FICLONE = 0x40049409
+_STORE_GC_GRACE = 3600
+_LINK_METHODS = {"auto": ["reflink", "hardlink", "copy"], "reflink": ["reflink", "copy"],
+                 "hardlink": ["hardlink", "copy"], "copy": ["copy"]}
+
+
+def _umask():
+    # os.umask can only be read by setting it, which would briefly change the mode of files other threads create.
+    # Linux reports it in /proc; elsewhere the mode of a freshly created file gives it away.
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("Umask:"):
+                    return int(line.split()[1], 8)
+    except OSError:
+        pass
+    probe_dir = tempfile.mkdtemp()
+    try:
+        probe = os.path.join(probe_dir, "probe")
+        os.close(os.open(probe, os.O_CREAT | os.O_WRONLY, 0o777))
+        return 0o777 & ~os.stat(probe).st_mode
+    finally:
+        shutil.rmtree(probe_dir, ignore_errors=True)
+
+
+def _reflink(source, target):
+    # Copy-on-write clone (FICLONE, Btrfs/XFS/bcachefs on Linux); other platforms and filesystems raise OSError.
+    if fcntl is None or not sys.platform.startswith("linux"):
+        raise OSError("reflinks are not supported on this platform")
+    with open(source, "rb") as source_file, open(target, "wb") as target_file:
+        fcntl.ioctl(target_file.fileno(), _FICLONE, source_file.fileno())
+
+
+def _remove_tree(path):
+    # Store entries have read-only directories, which rmtree can't empty until they are writable again.
+    for root, dir_names, _ in os.walk(path):
+        for dir_name in dir_names:
+            os.chmod(os.path.join(root, dir_name), 0o700)
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def _exchange_paths(first, second):
+    # Swaps two existing paths in one step with renameat2(RENAME_EXCHANGE) (Linux 3.15+, glibc 2.28+). Returns False
+    # where the platform, libc or filesystem can't, so the caller falls back to two renames.
+    if not sys.platform.startswith("linux"):
+        return False
+    import ctypes
+    import errno
+
+    renameat2 = getattr(ctypes.CDLL(None, use_errno=True), "renameat2", None)
+    if renameat2 is None:
+        return False
+    at_fdcwd, rename_exchange = -100, 2
+    if renameat2(at_fdcwd, os.fsencode(first), at_fdcwd, os.fsencode(second), rename_exchange) == 0:
+        return True
+    error = ctypes.get_errno()
+    if error in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+        return False
+    raise OSError(error, os.strerror(error), second)
+
+
+def _remove_path(path):
+    # Staged and replaced packages are directories, or symlinks into the store with `--link symlink`.
+    if os.path.islink(path) or os.path.isfile(path):
+        os.remove(path)
+    else:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def _pid_alive(pid):
+    # Only POSIX can probe a process without touching it (os.kill on Windows terminates it), so elsewhere every
+    # process counts as alive and its staging files are left alone.
+    if os.name != "posix":
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class ContentStore:
+    # Shared, read-only tree of extracted packages (`store/<name>@<version>-<sha>/package`) that projects link their
+    # modules/ entries to instead of unpacking a copy each. Entries are unpacked into a `.tmp-*` directory, made
+    # read-only and renamed into place together with their `manifest.json`, so a link can only ever see a complete
+    # package. Projects that link from the store are listed in `workspaces.json`; `gc` removes the entries none of
+    # their installed states refer to.
+    def __init__(self, root):
+        self.root = root
+        self.workspaces_path = os.path.join(root, "workspaces.json")
+
+    @contextlib.contextmanager
+    def _locked(self, shared=False):
+        # Installs hold the lock shared while they pick an entry and `gc` holds it exclusively, so an entry is never
+        # removed between its lookup and the link to it.
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, ".lock"), "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def path(self, package_name, package_version, sha256):
+        return os.path.join(self.root, f"{package_name}@{package_version}-{sha256[:16]}")
+
+    @staticmethod
+    def manifest(path):
+        try:
+            with open(os.path.join(path, "manifest.json")) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def get(self, package_name, package_version, sha256):
+        # Returns the path of a complete entry, marked as just used, or None.
+        path = self.path(package_name, package_version, sha256)
+        with self._locked(shared=True):
+            manifest = self.manifest(path)
+            if manifest is None or manifest["sha256"] != sha256:
+                return None
+            os.utime(os.path.join(path, "manifest.json"))
+        return path
+
+    def staging_dir(self, package_name):
+        # Where a package bound for the store is unpacked: `package/` inside a fresh `.tmp-*` directory.
+        os.makedirs(self.root, exist_ok=True)
+        package_dir = os.path.join(tempfile.mkdtemp(prefix=f".tmp-{package_name}-", dir=self.root), "package")
+        os.mkdir(package_dir)
+        return package_dir
+
+    def add(self, package_name, package_version, sha256, package_dir, files):
+        # Publishes a package unpacked into `staging_dir()`. If another install added the same entry first, that
+        # one is kept and this copy is dropped.
+        staging = os.path.dirname(package_dir)
+        path = self.path(package_name, package_version, sha256)
+        umask = _umask()
+        try:
+            for root, _, file_names in os.walk(package_dir, topdown=False):
+                for file_name in file_names:
+                    os.chmod(os.path.join(root, file_name), 0o444 & ~umask)
+                os.chmod(root, 0o555 & ~umask)
+            _write_json_atomic(os.path.join(staging, "manifest.json"), {
+                "name": package_name, "version": package_version, "sha256": sha256, "files": files,
+            })
+            os.chmod(staging, 0o755 & ~umask)
+            try:
+                os.rename(staging, path)
+            except OSError:
+                if self.manifest(path) is None:
+                    raise
+                _remove_tree(staging)
+        except BaseException:
+            _remove_tree(staging)
+            raise
+        return path
+
+    def link(self, path, target, mode):
+        # Creates `target` from the entry at `path`: one symlink to the entry, or a directory of reflinks, hard
+        # links or copies ("auto" tries them in that order). Links that the filesystem refuses, such as hard links
+        # across filesystems, fall back to copies. Returns the method used.
+        source = os.path.join(path, "package")
+        if mode == "symlink":
+            try:
+                os.symlink(source, target, target_is_directory=True)
+                return "symlink"
+            except OSError:
+                mode = "copy"
+        methods = list(_LINK_METHODS[mode])
+        os.mkdir(target)
+        for relative_path in self.manifest(path)["files"]:
+            source_path = os.path.join(source, *relative_path.split("/"))
+            target_path = os.path.join(target, *relative_path.split("/"))
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            while True:
+                try:
+                    if methods[0] == "reflink":
+                        _reflink(source_path, target_path)
+                    elif methods[0] == "hardlink":
+                        os.link(source_path, target_path)
+                    else:
+                        shutil.copyfile(source_path, target_path)
+                    break
+                except OSError:
+                    if len(methods) == 1:
+                        raise
+                    _remove_quietly(target_path)
+                    methods.pop(0)
+        return methods[0]
+
+    def workspaces(self):
+        try:
+            with open(self.workspaces_path) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return []
+
+    def register(self, modules_dir):
+        modules_dir = os.path.abspath(modules_dir)
+        if modules_dir in self.workspaces():
+            return
+        with self._locked():
+            workspaces = self.workspaces()
+            if modules_dir not in workspaces:
+                _write_json_atomic(self.workspaces_path, workspaces + [modules_dir])
+
+    def entries(self):
+        entries = {}
+        if os.path.isdir(self.root):
+            for name in sorted(os.listdir(self.root)):
+                manifest = None if name.startswith(".") else self.manifest(os.path.join(self.root, name))
+                if manifest is not None:
+                    entries[name] = manifest
+        return entries
+
+    def _discard(self, path):
+        # Renamed out of the way first, so nothing can link to a half-deleted entry.
+        trash = tempfile.mkdtemp(prefix=".trash-", dir=self.root)
+        os.rename(path, os.path.join(trash, "entry"))
+        _remove_tree(trash)
+
+    def gc(self):
+        # Removes the entries that no registered workspace has installed and that weren't used in the last hour,
+        # along with abandoned staging directories, and forgets workspaces that no longer exist. Returns the names of
+        # the removed entries.
+        if not os.path.isdir(self.root):
+            return []
+        removed = []
+        with self._locked():
+            workspaces = []
+            referenced = set()
+            for modules_dir in self.workspaces():
+                state = InstalledState(modules_dir)
+                if os.path.exists(state.path):
+                    workspaces.append(modules_dir)
+                    referenced.update(entry.get("store") for entry in state.packages().values())
+            _write_json_atomic(self.workspaces_path, workspaces)
+            for name in os.listdir(self.root):
+                path = os.path.join(self.root, name)
+                manifest_path = os.path.join(path, "manifest.json")
+                if not os.path.isdir(path) or name in referenced:
+                    continue
+                if name.startswith((".tmp-", ".trash-")):
+                    if time.time() - os.path.getmtime(path) > _STORE_GC_GRACE:
+                        _remove_tree(path)
+                elif not name.startswith(".") and (not os.path.exists(manifest_path)
+                                                   or time.time() - os.path.getmtime(manifest_path) > _STORE_GC_GRACE):
+                    self._discard(path)
+                    removed.append(name)
+        return sorted(removed)
+
+    def verify(self):
+        # Re-hashes every entry against its manifest and removes the ones that don't match. Returns their names.
+        corrupt = []
+        for name, manifest in self.entries().items():
+            package_dir = os.path.join(self.root, name, "package")
+            for relative_path, recorded in manifest["files"].items():
+                path = os.path.join(package_dir, *relative_path.split("/"))
+                if not os.path.isfile(path) or _sha256_file(path) != recorded["sha256"]:
+                    corrupt.append(name)
+                    break
+        if corrupt:
+            with self._locked():
+                for name in corrupt:
+                    self._discard(os.path.join(self.root, name))
+        return corrupt
+
+
+def _version_key(version):
+    # Semver precedence, e.g. 2.0.0-alpha < 2.0.0-rc.1 < 2.0.0-rc.2 < 2.0.0 < 2.0.1. Build metadata is ignored.
+    release, _, prerelease = version.replace("_", ".").split("+")[0].partition("-")
+    numbers = [int(part) if part.isdigit() else 0 for part in release.split(".")[:3]]
+    numbers += [0] * (3 - len(numbers))
+    if not prerelease:
+        return (*numbers, (1,))
+    return (*numbers, (0,) + tuple((0, int(part), "") if part.isdigit() else (1, 0, part)
+                                   for part in prerelease.split(".")))
+
+
+def _split_spec(package_spec):
+    # `name` or `name@range`, e.g. `math@1.2.0` or `math@^1.2`
+    package_name, _, package_range = package_spec.partition("@")
+    return package_name, package_range or None
+
+
+def _latest_version(versions):
+    # The highest release; prereleases only count for packages that have nothing else.
+    releases = [version for version in versions if _version_key(version)[3] == (1,)]
+    return max(releases or versions, key=_version_key)
+
+
+def _satisfies(version, package_range):
+    # npm-style ranges: `1.2.3`, `=1.2.3`, `>=1.2 <2`, `^1.2.3`, `~1.2`, `1.x`, `*`, and alternatives joined by `||`.
+    # As in npm, a prerelease only matches an alternative that names a prerelease of the same x.y.z, so `*` or `^1.1`
+    # never picks 1.2.0-beta but `>=1.2.0-alpha` does.
+    version = _version_key(version)
+    for alternative in (package_range or "*").split("||"):
+        terms = alternative.split()
+        if version[3] != (1,) and not any("-" in term and _version_key(term.lstrip("<>=^~"))[:3] == version[:3]
+                                          for term in terms):
+            continue
+        if all(_satisfies_term(version, term) for term in terms):
+            return True
+    return False
+
+
+def _satisfies_term(version, term):
+    operator = next((op for op in (">=", "<=", ">", "<", "=", "^", "~") if term.startswith(op)), "")
+    bound = term[len(operator):]
+    numbers = []
+    for part in bound.split("-")[0].split("+")[0].split("."):
+        if part in ("x", "X", "*", ""):
+            break
+        numbers.append(int(part))
+    if not numbers:
+        return operator not in ("<", ">")
+    lower = _version_key(bound)
+    if len(numbers) < 3 and operator in (">", "<=", "<"):
+        # As in npm, a partial version stands for everything it covers: `>1.2` is >=1.3.0, `<=1.2` is <1.3.0 and
+        # `<1.2` is <1.2.0, the last two also excluding the bound's prereleases.
+        if operator == "<":
+            return version < lower[:3] + ((0,),)
+        end = (*numbers[:-1], numbers[-1] + 1) + (0,) * (3 - len(numbers))
+        return version >= end + ((1,),) if operator == ">" else version < end + ((0,),)
+    if operator == ">=":
+        return version >= lower
+    if operator == ">":
+        return version > lower
+    if operator == "<=":
+        return version <= lower
+    if operator == "<":
+        return version < lower
+    if operator == "^":
+        fixed = next((i for i, number in enumerate(numbers) if number != 0), len(numbers) - 1)
+    elif operator == "~":
+        fixed = 1 if len(numbers) > 1 else 0
+    elif len(numbers) < 3:
+        fixed = len(numbers) - 1
+    else:
+        return version == lower
+    fixed = min(fixed, 2)
+    # The upper bound sorts below its own prereleases: ^1.2.3 stops before 2.0.0-rc1.
+    upper = lower[:fixed] + (lower[fixed] + 1,) + (0,) * (2 - fixed) + ((0,),)
+    return lower <= version < upper
+
+
+def _registry_suffix(server_url):
+    # Caches of registry data are kept apart per registry by a short hash of its URL; the default has none.
+    return f"-{hashlib.sha256(server_url.encode()).hexdigest()[:12]}" if server_url else ""
+
+
+class RegistryIndex:
+    # Local copy of `packages/index.json`, the registry manifest listing every package with its versions, hashes
+    # and sizes. It is refreshed with a conditional request (generation or ETag) at most once per process and once
+    # per `ttl` seconds, so version lookups don't need a round-trip per package.
+    path = "packages/index.json"
+
+    def __init__(self, root, storage, server_url="", ttl=None):
+        self.local_path = os.path.join(root, f"registry-index{_registry_suffix(server_url)}.json")
+        self.storage = storage
+        self.ttl = float(ttl if ttl is not None else _config("INDEX_TTL", 300))
+        self._lock = threading.Lock()
+        self._data = None
+
+    def _load_local(self):
+        try:
+            with open(self.local_path) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def refresh(self, force=False):
+        with self._lock:
+            if self._data is not None and not force:
+                return self._data
+            local = self._load_local()
+            if local is not None and not force and time.time() - local["fetched_at"] < self.ttl:
+                self._data = local
+                return local
+
+            try:
+                data, tag = self.storage.read(self.path, if_none_match=local.get("tag") if local else None)
+                if data is not None:
+                    local = {"tag": tag, "packages": json.loads(data).get("packages", {})}
+            except StorageNotFound:
+                local = {"tag": None, "packages": {}}
+            local["fetched_at"] = time.time()
+            os.makedirs(os.path.dirname(self.local_path), exist_ok=True)
+            _write_json_atomic(self.local_path, local)
+            self._data = local
+            return local
+
+    def expire(self):
+        # Long-lived processes (`ptm daemon`) call this between commands so the in-memory copy also obeys `ttl`.
+        with self._lock:
+            if self._data is not None and time.time() - self._data["fetched_at"] >= self.ttl:
+                self._data = None
+
+    def packages(self):
+        return self.refresh()["packages"]
+
+    def release(self, package_name, package_range=None):
+        package = self.packages().get(package_name)
+        if package is None:
+            return None
+        if package_range is None:
+            package_version = _latest_version(package["versions"])
+        elif package_range in package["versions"]:
+            package_version = package_range
+        else:
+            candidates = [version for version in package["versions"] if _satisfies(version, package_range)]
+            if not candidates:
+                return None
+            package_version = max(candidates, key=_version_key)
+        return dict(package["versions"][package_version], name=package_name, version=package_version)
+
+    def latest(self, package_name):
+        package = self.packages().get(package_name)
+        return _latest_version(package["versions"]) if package else None
+
+    def publish(self, package_name, package_version, archive_path, blob_path, dependencies=None, sha256=None,
+                index_sha256=None):
+        # Read-modify-write of the remote manifest, guarded by its tag so concurrent uploads don't overwrite each
+        # other's entries. PTM2 packages also record the hash of their header and index, for ranged installs.
+        release = {"sha256": sha256 or _sha256_file(archive_path), "size": os.path.getsize(archive_path),
+                   "path": blob_path, "dependencies": dependencies or {}}
+        if index_sha256 is not None:
+            release.update(format=2, index_sha256=index_sha256)
+        for _ in range(10):
+            try:
+                data, tag = self.storage.read(self.path)
+                data = json.loads(data)
+            except StorageNotFound:
+                data, tag = {"packages": {}}, ""
+            package = data["packages"].setdefault(package_name, {"versions": {}})
+            package["versions"][package_version] = release
+            package["latest"] = _latest_version(package["versions"])
+            try:
+                self.storage.write(self.path, json.dumps(data, sort_keys=True, separators=(",", ":")).encode(),
+                                   content_type="application/json", if_match=tag)
+                return release
+            except StorageConflict:
+                continue
+        raise RuntimeError(f"Could not update the registry index for '{package_name}'.")
+
+
+class MetadataCache:
+    # package.json documents keyed by `name@version`, kept in memory and in `metadata<suffix>.json` next to the
+    # registry index. Packages that don't exist are remembered as None for the shorter `negative_ttl`, so a typo in a
+    # long dependency list doesn't cost a round-trip on every run.
+    def __init__(self, root, server_url="", ttl=None, negative_ttl=None):
+        self.path = os.path.join(root, f"metadata{_registry_suffix(server_url)}.json")
+        self.ttl = float(ttl if ttl is not None else _config("METADATA_TTL", 3600))
+        self.negative_ttl = float(negative_ttl if negative_ttl is not None else _config("METADATA_NEGATIVE_TTL", 60))
+        self._lock = threading.Lock()
+        self._entries = None
+
+    def _load(self):
+        try:
+            with open(self.path) as file:
+                return json.load(file)["entries"]
+        except (OSError, ValueError, KeyError):
+            return {}
+
+    def get(self, key):
+        # Returns (found, package_info); package_info is None for a cached miss.
+        with self._lock:
+            if self._entries is None:
+                self._entries = self._load()
+            entry = self._entries.get(key)
+        if entry is None:
+            return False, None
+        ttl = self.ttl if entry["info"] is not None else self.negative_ttl
+        if time.time() - entry["fetched_at"] >= ttl:
+            return False, None
+        return True, entry["info"]
+
+    def put_many(self, infos):
+        if not infos:
+            return
+        now = time.time()
+        with _locked_file(f"{self.path}.lock", self._lock):
+            entries = self._load()
+            entries.update({key: {"fetched_at": now, "info": info} for key, info in infos.items()})
+            entries = {key: entry for key, entry in entries.items()
+                       if now - entry["fetched_at"] < (self.ttl if entry["info"] is not None else self.negative_ttl)}
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            _write_json_atomic(self.path, {"version": 1, "entries": entries})
+            self._entries = entries
+
+
+_LOCAL_HEADER = struct.Struct("<4sHHHHHIIIHH")
+_CENTRAL_HEADER = struct.Struct("<4sHHHHHHIIIHHHHHII")
+_END_OF_CENTRAL_DIRECTORY = struct.Struct("<4sHHHHIIH")
+_LOCAL_SIGNATURE = b"PK\x03\x04"
+_CENTRAL_SIGNATURE = b"PK\x01\x02"
+_DESCRIPTOR_SIGNATURE = b"PK\x07\x08"
+_END_SIGNATURE = b"PK\x05\x06"
+_SPOOL_MEMORY_LIMIT = 32 * 1024 * 1024
+
+
+def _zip64_sizes(extra, compressed_size, file_size):
+    while len(extra) >= 4:
+        header_id, length = struct.unpack("<HH", extra[:4])
+        if header_id == 0x0001:
+            values = extra[4:4 + length]
+            if file_size == 0xFFFFFFFF and len(values) >= 8:
+                file_size, values = struct.unpack("<Q", values[:8])[0], values[8:]
+            if compressed_size == 0xFFFFFFFF and len(values) >= 8:
+                compressed_size = struct.unpack("<Q", values[:8])[0]
+            break
+        extra = extra[4 + length:]
+    return compressed_size, file_size
+
+
+class _ZipLZMADecompressor:
+    # Zip stores LZMA entries (method 14) as raw LZMA1 behind a small header: version (2 bytes), the length of the
+    # properties (2 bytes, little-endian) and the properties themselves. The raw decoder is built once they arrive.
+    def __init__(self):
+        self._header = b""
+        self._decompressor = None
+
+    @property
+    def eof(self):
+        return self._decompressor is not None and self._decompressor.eof
+
+    @property
+    def unused_data(self):
+        return self._decompressor.unused_data if self._decompressor is not None else b""
+
+    def decompress(self, data):
+        if self._decompressor is None:
+            import lzma
+
+            self._header += data
+            if len(self._header) < 4:
+                return b""
+            properties_end = 4 + struct.unpack_from("<H", self._header, 2)[0]
+            if len(self._header) < properties_end:
+                return b""
+            filters = [lzma._decode_filter_properties(lzma.FILTER_LZMA1, self._header[4:properties_end])]
+            self._decompressor = lzma.LZMADecompressor(lzma.FORMAT_RAW, filters=filters)
+            data, self._header = self._header[properties_end:], None
+        return self._decompressor.decompress(data)
+
+
+def _relative_parts(path):
+    # The components of a relative `/`-separated path; absolute paths, drive letters and `..` raise ValueError.
+    parts = [part for part in path.replace("\\", "/").split("/") if part not in ("", ".")]
+    if path.startswith(("/", "\\")) or ".." in parts or (parts and ":" in parts[0]):
+        raise ValueError(f"Unsafe path: '{path}'")
+    return parts
+
+
+def _safe_member_path(destination, name):
+    try:
+        parts = _relative_parts(name)
+    except ValueError:
+        raise zipfile.BadZipFile(f"Unsafe path in archive: '{name}'") from None
+    return os.path.join(destination, *parts)
+
+
+def _selects(only, name):
+    # `only` is a list of glob patterns (`*` also matches `/`); package.json is always extracted.
+    return only is None or name == "package.json" or any(fnmatch.fnmatchcase(name, pattern) for pattern in only)
+
+
+class _ZipStreamExtractor:
+    # Extracts a zip archive while its bytes arrive, using the sizes from each local file header. Only a stored
+    # entry written with a trailing data descriptor has no size up front; from that entry on the rest of the
+    # stream is spooled (in memory, or a temp file past 32 MiB) and replayed once the central directory is known.
+    def __init__(self, destination, only=None):
+        self.destination = destination
+        self.only = only
+        self._buffer = bytearray()
+        self._entry = None
+        self._descriptor = None
+        self._finished = False
+        self._spool = None
+        self._central_sizes = None
+        self.files = {}
+
+    def feed(self, data):
+        if self._spool is not None:
+            self._spool.write(data)
+            return
+        self._buffer += data
+        self._drain()
+
+    def close(self):
+        if self._spool is not None:
+            self._replay_spool()
+        if self._entry is not None or self._descriptor is not None or not self._finished:
+            raise zipfile.BadZipFile("Archive ended unexpectedly.")
+
+    def _drain(self):
+        while self._spool is None:
+            if self._descriptor is not None:
+                if not self._read_descriptor():
+                    return
+            elif self._entry is not None:
+                if not self._read_entry_data():
+                    return
+            elif self._finished:
+                self._buffer.clear()
+                return
+            elif not self._read_header():
+                return
+
+    def _read_header(self):
+        if len(self._buffer) < 4:
+            return False
+        signature = bytes(self._buffer[:4])
+        if signature != _LOCAL_SIGNATURE:
+            if signature in (_CENTRAL_SIGNATURE, _END_SIGNATURE, b"PK\x06\x06"):
+                self._finished = True
+                return True
+            raise zipfile.BadZipFile("Not a zip archive.")
+        if len(self._buffer) < _LOCAL_HEADER.size:
+            return False
+        (_, _, flags, method, _, _, crc, compressed_size, file_size,
+         name_length, extra_length) = _LOCAL_HEADER.unpack_from(self._buffer)
+        header_length = _LOCAL_HEADER.size + name_length + extra_length
+        if len(self._buffer) < header_length:
+            return False
+        raw_name = bytes(self._buffer[_LOCAL_HEADER.size:_LOCAL_HEADER.size + name_length])
+        name = raw_name.decode("utf-8" if flags & 0x800 else "cp437")
+        extra = bytes(self._buffer[_LOCAL_HEADER.size + name_length:header_length])
+        compressed_size, file_size = _zip64_sizes(extra, compressed_size, file_size)
+        if flags & 0x1:
+            raise zipfile.BadZipFile(f"Encrypted entry '{name}' is not supported.")
+        if method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED, zipfile.ZIP_BZIP2, zipfile.ZIP_LZMA):
+            raise zipfile.BadZipFile(f"Unsupported compression method {method} for '{name}'.")
+
+        has_descriptor = bool(flags & 0x8)
+        if has_descriptor and self._central_sizes is not None:
+            compressed_size, crc = self._central_sizes[name]
+        elif has_descriptor and method == zipfile.ZIP_STORED:
+            # The end of a stored entry can't be found without the central directory.
+            self._start_spool()
+            return False
+        elif has_descriptor:
+            compressed_size = None
+
+        del self._buffer[:header_length]
+        path = _safe_member_path(self.destination, name)
+        if name.endswith("/"):
+            if self.only is None:
+                os.makedirs(path, exist_ok=True)
+            file = None
+        elif not _selects(self.only, name):
+            file = None
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            file = open(path, "wb")
+        if method == zipfile.ZIP_DEFLATED:
+            decompressor = zlib.decompressobj(-15)
+        elif method == zipfile.ZIP_BZIP2:
+            decompressor = bz2.BZ2Decompressor()
+        elif method == zipfile.ZIP_LZMA:
+            decompressor = _ZipLZMADecompressor()
+        else:
+            decompressor = None
+        self._entry = {
+            "name": name,
+            "path": path,
+            "file": file,
+            "sha256": hashlib.sha256(),
+            "decompressor": decompressor,
+            "remaining": compressed_size,
+            "descriptor": has_descriptor,
+            "crc": crc,
+            "actual_crc": 0,
+            "compressed": 0,
+            "written": 0,
+        }
+        return True
+
+    def _read_entry_data(self):
+        entry = self._entry
+        if not self._buffer and entry["remaining"] != 0:
+            return False
+        if entry["remaining"] is not None:
+            data = bytes(self._buffer[:entry["remaining"]])
+            entry["remaining"] -= len(data)
+            done = entry["remaining"] == 0
+        else:
+            data = bytes(self._buffer)
+            done = False
+        del self._buffer[:len(data)]
+        entry["compressed"] += len(data)
+
+        decompressor = entry["decompressor"]
+        if decompressor is not None:
+            output = decompressor.decompress(data)
+            if entry["remaining"] is None and decompressor.eof:
+                # The compressed stream ended inside this chunk: hand back what belongs to the next record.
+                unused = decompressor.unused_data
+                self._buffer[:0] = unused
+                entry["compressed"] -= len(unused)
+                done = True
+        else:
+            output = data
+        if output:
+            entry["actual_crc"] = zlib.crc32(output, entry["actual_crc"])
+            entry["written"] += len(output)
+            if entry["file"] is not None:
+                entry["file"].write(output)
+                entry["sha256"].update(output)
+        if done:
+            if entry["file"] is not None:
+                entry["file"].close()
+                self.files[entry["name"]] = {
+                    "sha256": entry["sha256"].hexdigest(),
+                    "size": entry["written"],
+                    "mtime_ns": os.stat(entry["path"]).st_mtime_ns,
+                }
+            self._entry = None
+            if entry["descriptor"]:
+                self._descriptor = entry
+            else:
+                self._check_crc(entry, entry["crc"])
+        return True
+
+    def _read_descriptor(self):
+        entry = self._descriptor
+        offset = 4 if self._buffer[:4] == _DESCRIPTOR_SIGNATURE else 0
+        # Sizes are 4 bytes each, or 8 for zip64; the record is followed by another signature either way.
+        for size_length in (4, 8):
+            end = offset + 4 + 2 * size_length
+            if len(self._buffer) < end + 4:
+                return False
+            crc, compressed_size = struct.unpack_from("<I" + ("I" if size_length == 4 else "Q"), self._buffer, offset)
+            if compressed_size == entry["compressed"] and bytes(self._buffer[end:end + 2]) == b"PK":
+                del self._buffer[:end]
+                self._descriptor = None
+                self._check_crc(entry, crc)
+                return True
+        raise zipfile.BadZipFile(f"Bad data descriptor for '{entry['name']}'.")
+
+    def _check_crc(self, entry, crc):
+        if entry["actual_crc"] != crc:
+            raise zipfile.BadZipFile(f"CRC mismatch for '{entry['name']}'.")
+
+    def _start_spool(self):
+        self._spool = tempfile.SpooledTemporaryFile(max_size=_SPOOL_MEMORY_LIMIT)
+        self._spool.write(self._buffer)
+        self._buffer.clear()
+
+    def _replay_spool(self):
+        spool, self._spool = self._spool, None
+        with spool:
+            spool.seek(0, os.SEEK_END)
+            spool_size = spool.tell()
+            tail_size = min(spool_size, 65536 + _END_OF_CENTRAL_DIRECTORY.size)
+            spool.seek(spool_size - tail_size)
+            tail = spool.read()
+            end = tail.rfind(_END_SIGNATURE)
+            if end < 0:
+                raise zipfile.BadZipFile("End of central directory not found.")
+            central_size = _END_OF_CENTRAL_DIRECTORY.unpack_from(tail, end)[5]
+            spool.seek(spool_size - tail_size + end - central_size)
+            central = spool.read(central_size)
+
+            self._central_sizes = {}
+            offset = 0
+            while central[offset:offset + 4] == _CENTRAL_SIGNATURE:
+                fields = _CENTRAL_HEADER.unpack_from(central, offset)
+                flags, crc, compressed_size, file_size = fields[3], fields[7], fields[8], fields[9]
+                name_length, extra_length, comment_length = fields[10], fields[11], fields[12]
+                name_start = offset + _CENTRAL_HEADER.size
+                name = central[name_start:name_start + name_length].decode("utf-8" if flags & 0x800 else "cp437")
+                extra = central[name_start + name_length:name_start + name_length + extra_length]
+                self._central_sizes[name] = (_zip64_sizes(extra, compressed_size, file_size)[0], crc)
+                offset = name_start + name_length + extra_length + comment_length
+
+            spool.seek(0)
+            for chunk in iter(lambda: spool.read(1024 * 1024), b""):
+                self._buffer += chunk
+                self._drain()
+
+
+_PTM2_MAGIC = b"PTM2"
+_PTM2_HEADER = struct.Struct("<4sHHIQ")
+_PTM2_COMPRESSIONS = ("zlib", "xz", "zstd")
+_RANGE_MERGE_GAP = 256 * 1024
+
+
+def _zstd():
+    # zstd is optional: the stdlib module on Python 3.14+, otherwise the `zstandard` package.
+    try:
+        from compression import zstd
+        return zstd.ZstdCompressor(level=12), zstd.ZstdDecompressor
+    except ImportError:
+        pass
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError("zstd packages need Python 3.14+ or the 'zstandard' package.")
+    return zstandard.ZstdCompressor(level=12).compressobj(), lambda: zstandard.ZstdDecompressor().decompressobj()
+
+
+def _compressor(method):
+    if method == "zlib":
+        return zlib.compressobj(9)
+    if method == "xz":
+        import lzma
+
+        return lzma.LZMACompressor()
+    if method == "zstd":
+        return _zstd()[0]
+    raise ValueError(f"Unknown compression '{method}' (expected zip, {', '.join(_PTM2_COMPRESSIONS)}).")
+
+
+def _decompressor(method):
+    if method == "none":
+        return None
+    if method == "zlib":
+        return zlib.decompressobj()
+    if method == "xz":
+        import lzma
+
+        return lzma.LZMADecompressor()
+    if method == "zstd":
+        return _zstd()[1]()
+    raise IOError(f"Unknown compression '{method}' in package.")
+
+
+def _parse_ptm2_index(buffer):
+    # Returns (index, data offset, data length) once `buffer` holds the header and the index, else None.
+    if len(buffer) < _PTM2_HEADER.size:
+        return None
+    magic, version, _, index_length, data_length = _PTM2_HEADER.unpack_from(buffer)
+    if magic != _PTM2_MAGIC or version != 2:
+        raise IOError("Not a PTM2 package.")
+    data_offset = _PTM2_HEADER.size + index_length
+    if len(buffer) < data_offset:
+        return None
+    return json.loads(zlib.decompress(bytes(buffer[_PTM2_HEADER.size:data_offset]))), data_offset, data_length
+
+
+class _Ptm2StreamExtractor:
+    # Extracts a PTM2 package while its bytes arrive: the header and index come first, then every file's compressed
+    # bytes in index order. Given an `index`, it is fed ranges of the data section instead (each started with
+    # `seek`), and extracts only the files the index lists as selected.
+    def __init__(self, destination, only=None, index=None):
+        self.destination = destination
+        self.only = only
+        self._buffer = bytearray()
+        self._index = None
+        self._entries = None
+        self._entry = None
+        self._position = 0
+        self._data_length = None
+        self.files = {}
+        if index is not None:
+            self._index = index
+            self._entries = collections.deque(sorted(
+                (entry for entry in index["files"] if _selects(only, entry["name"])), key=lambda e: e["offset"]))
+
+    def selected(self):
+        return list(self._entries)
+
+    def seek(self, offset):
+        if self._entry is not None or self._buffer:
+            raise IOError("Package range ended inside a file.")
+        self._position = offset
+
+    def feed(self, data):
+        self._buffer += data
+        self._drain()
+
+    def close(self):
+        if self._index is None or self._entry is not None or self._entries or self._buffer:
+            raise IOError("Package ended unexpectedly.")
+        if self._data_length is not None and self._position != self._data_length:
+            raise IOError("Package size does not match its header.")
+
+    def _drain(self):
+        while True:
+            if self._index is None:
+                parsed = _parse_ptm2_index(self._buffer)
+                if parsed is None:
+                    return
+                self._index, data_offset, self._data_length = parsed
+                del self._buffer[:data_offset]
+                self._entries = collections.deque(self._index["files"])
+            elif self._entry is None:
+                if not self._entries:
+                    if self._buffer:
+                        raise IOError("Unexpected data after the last file of the package.")
+                    return
+                gap = self._entries[0]["offset"] - self._position
+                if gap < 0:
+                    raise IOError("Files in the package overlap.")
+                if gap:
+                    skipped = min(gap, len(self._buffer))
+                    del self._buffer[:skipped]
+                    self._position += skipped
+                    if skipped < gap:
+                        return
+                self._open(self._entries.popleft())
+            else:
+                entry = self._entry
+                if not self._buffer and entry["remaining"]:
+                    return
+                data = bytes(self._buffer[:entry["remaining"]])
+                del self._buffer[:len(data)]
+                entry["remaining"] -= len(data)
+                self._position += len(data)
+                if entry["file"] is not None:
+                    output = data if entry["decompressor"] is None else entry["decompressor"].decompress(data)
+                    entry["file"].write(output)
+                    entry["sha256"].update(output)
+                    entry["written"] += len(output)
+                if not entry["remaining"]:
+                    self._finish(entry)
+
+    def _open(self, entry):
+        name = entry["name"]
+        path = _safe_member_path(self.destination, name)
+        selected = _selects(self.only, name)
+        if selected:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._entry = {
+            "name": name,
+            "path": path,
+            "file": open(path, "wb") if selected else None,
+            "decompressor": _decompressor(entry["compression"]) if selected else None,
+            "sha256": hashlib.sha256(),
+            "expected_sha256": entry["sha256"],
+            "size": entry["size"],
+            "remaining": entry["compressed_size"],
+            "written": 0,
+        }
+
+    def _finish(self, entry):
+        self._entry = None
+        if entry["file"] is None:
+            return
+        decompressor = entry["decompressor"]
+        if decompressor is not None and hasattr(decompressor, "flush"):
+            output = decompressor.flush()
+            entry["file"].write(output)
+            entry["sha256"].update(output)
+            entry["written"] += len(output)
+        entry["file"].close()
+        if entry["written"] != entry["size"] or entry["sha256"].hexdigest() != entry["expected_sha256"]:
+            raise IOError(f"Checksum mismatch for '{entry['name']}'.")
+        self.files[entry["name"]] = {
+            "sha256": entry["expected_sha256"],
+            "size": entry["size"],
+            "mtime_ns": os.stat(entry["path"]).st_mtime_ns,
+        }
+
+
+class _PackageExtractor:
+    # Streams a package into `destination` with the extractor its first bytes call for: zip for the original
+    # format, PTM2 for format 2.
+    def __init__(self, destination, only=None):
+        self.destination = destination
+        self.only = only
+        self._head = bytearray()
+        self._extractor = None
+
+    @property
+    def files(self):
+        return self._extractor.files if self._extractor is not None else {}
+
+    def feed(self, data):
+        if self._extractor is None:
+            self._head += data
+            if len(self._head) < 4:
+                return
+            if self._head[:4] == _PTM2_MAGIC:
+                self._extractor = _Ptm2StreamExtractor(self.destination, self.only)
+            else:
+                self._extractor = _ZipStreamExtractor(self.destination, self.only)
+            data, self._head = bytes(self._head), None
+        self._extractor.feed(data)
+
+    def close(self):
+        if self._extractor is None:
+            raise IOError("Package ended unexpectedly.")
+        self._extractor.close()
+
+
+_MIN_CHUNK_SIZE = 64 * 1024
+_MAX_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def _iter_response(response):
+    # Grow the read size while the connection keeps filling it quickly, shrink it when reads stall, so fast
+    # links aren't throttled by per-chunk overhead and slow ones still report progress.
+    chunk_size = _MIN_CHUNK_SIZE
+    while True:
+        started = time.monotonic()
+        chunk = response.raw.read(chunk_size, decode_content=True)
+        if not chunk:
+            return
+        elapsed = time.monotonic() - started
+        yield chunk
+        if len(chunk) == chunk_size and elapsed < 0.05:
+            chunk_size = min(chunk_size * 2, _MAX_CHUNK_SIZE)
+        elif elapsed > 0.5:
+            chunk_size = max(chunk_size // 2, _MIN_CHUNK_SIZE)
+
+
+class _TransferInterrupted(Exception):
+    pass
+
+
+class _Downloader:
+    # HTTP transfers that survive flaky connections. A dropped or truncated response is resumed with a `Range`
+    # request from the last byte received, with exponential backoff between attempts; `retries` bounds the number of
+    # consecutive attempts that make no progress. `fetch_segments` splits large objects into ranged segments fetched
+    # on parallel connections.
+    def __init__(self, retries=None, backoff=None, connections=None, segment_threshold=None, timeout=30,
+                 headers=None):
+        import requests
+
+        self.retries = int(retries if retries is not None else _config("DOWNLOAD_RETRIES", 5))
+        self.backoff = float(backoff if backoff is not None else _config("DOWNLOAD_BACKOFF", 0.5))
+        self.connections = int(connections if connections is not None else _config("DOWNLOAD_CONNECTIONS", 4))
+        self.segment_threshold = _parse_size(segment_threshold if segment_threshold is not None
+                                             else _config("SEGMENT_THRESHOLD", "64M"))
+        self.timeout = timeout
+        self.retries_used = 0
+        self._session = requests.Session()
+        self._session.headers.update(headers or {})
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(self.connections, os.cpu_count() or 1) * 2)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._lock = threading.Lock()
+
+    def _open(self, url, start, end):
+        import requests
+        import urllib3
+
+        headers = {}
+        if start or end is not None:
+            headers["Range"] = f"bytes={start}-{'' if end is None else end - 1}"
+        try:
+            response = self._session.get(url, headers=headers, stream=True, timeout=self.timeout)
+        except (requests.RequestException, urllib3.exceptions.HTTPError, OSError) as e:
+            raise _TransferInterrupted(str(e)) from e
+        if response.status_code == 429 or response.status_code >= 500:
+            response.close()
+            raise _TransferInterrupted(f"HTTP {response.status_code}")
+        response.raise_for_status()
+        return response
+
+    def stream(self, url, consume, start=0, end=None, on_retry=None):
+        # Passes bytes [start, end) of the object to `consume` exactly once and in order, however many connections
+        # it takes. With `end=None` the object's size is taken from the first response. Returns the end offset.
+        # `on_retry` is called before every retry.
+        import requests
+        import urllib3
+
+        if url.startswith("file://"):
+            return self._stream_file(url, consume, start, end)
+
+        position = start
+        failures = 0
+        while True:
+            try:
+                response = self._open(url, position, end)
+                try:
+                    skip = 0
+                    if response.status_code != 206:
+                        # The server ignored the Range header and is sending the whole object again.
+                        skip = position
+                        if end is None and response.headers.get("content-length"):
+                            end = int(response.headers["content-length"])
+                    elif end is None:
+                        end = int(response.headers.get("content-range", "*/0").rsplit("/", 1)[1]) or None
+                    chunks = _iter_response(response)
+                    while end is None or position < end:
+                        try:
+                            chunk = next(chunks, None)
+                        except (requests.RequestException, urllib3.exceptions.HTTPError, OSError) as e:
+                            raise _TransferInterrupted(str(e)) from e
+                        if chunk is None:
+                            break
+                        if skip:
+                            dropped = min(skip, len(chunk))
+                            chunk, skip = chunk[dropped:], skip - dropped
+                        if end is not None:
+                            chunk = chunk[:end - position]
+                        if chunk:
+                            consume(chunk)
+                            position += len(chunk)
+                            failures = 0
+                finally:
+                    response.close()
+                if end is None or position >= end:
+                    return position
+                raise _TransferInterrupted(f"connection closed after {position} of {end} bytes")
+            except _TransferInterrupted:
+                failures += 1
+                if failures > self.retries:
+                    raise
+                with self._lock:
+                    self.retries_used += 1
+                if on_retry is not None:
+                    on_retry()
+                time.sleep(min(self.backoff * 2 ** (failures - 1), 30) * random.uniform(0.5, 1.5))
+
+    def _stream_file(self, url, consume, start, end):
+        import urllib.parse
+        import urllib.request
+
+        with open(urllib.request.url2pathname(urllib.parse.urlparse(url).path), "rb") as file:
+            file.seek(start)
+            position = start
+            while end is None or position < end:
+                chunk = file.read(_MAX_CHUNK_SIZE if end is None else min(_MAX_CHUNK_SIZE, end - position))
+                if not chunk:
+                    break
+                consume(chunk)
+                position += len(chunk)
+        return position
+
+    def fetch_segments(self, url, path, size, on_progress, on_retry=None):
+        # Downloads [0, size) into `path` as parallel ranged segments. Finished segments are listed in a sidecar
+        # file, so an interrupted fetch only repeats the segments that hadn't completed.
+        segment_size = max(-(-size // self.connections), 8 * 1024 * 1024)
+        segments = [(begin, min(begin + segment_size, size)) for begin in range(0, size, segment_size)]
+        sidecar_path = f"{path}.segments"
+        done = set()
+        if os.path.exists(path) and os.path.getsize(path) == size:
+            try:
+                with open(sidecar_path) as file:
+                    done = set(json.load(file))
+            except (OSError, ValueError):
+                pass
+        with open(path, "r+b" if os.path.exists(path) else "wb") as file:
+            file.truncate(size)
+        for index in done:
+            on_progress(segments[index][1] - segments[index][0])
+
+        def fetch(index):
+            begin, end = segments[index]
+            with open(path, "r+b") as file:
+                file.seek(begin)
+
+                def consume(chunk):
+                    file.write(chunk)
+                    on_progress(len(chunk))
+
+                self.stream(url, consume, begin, end, on_retry)
+            with self._lock:
+                done.add(index)
+                _write_json_atomic(sidecar_path, sorted(done))
+
+        pending = [index for index in range(len(segments)) if index not in done]
+        with _thread_pool(self.connections) as pool:
+            for future in [pool.submit(fetch, index) for index in pending]:
+                future.result()
+        if os.path.exists(sidecar_path):
+            os.remove(sidecar_path)
+
+
+_ARCHIVE_TIMESTAMP = (1980, 1, 1, 0, 0, 0)
+
+
+def _build_archive(source_dir, archive_path, compression="zip"):
+    # Sorted entries, fixed timestamps and permissions: the same sources always produce the same bytes, so an
+    # unchanged package hashes the same as the copy already in the registry. Any compression but "zip" builds a
+    # PTM2 package; its return value is the SHA-256 of the PTM2 header and index.
+    entries = []
+    for root, dir_names, file_names in os.walk(source_dir):
+        dir_names.sort()
+        for file_name in file_names:
+            path = os.path.join(root, file_name)
+            if file_name.endswith((".ptm", ".part")) or os.path.abspath(path) == os.path.abspath(archive_path):
+                continue
+            entries.append((os.path.relpath(path, source_dir).replace(os.sep, "/"), path))
+    if compression != "zip":
+        return _build_ptm2(sorted(entries), archive_path, compression)
+    with zipfile.ZipFile(archive_path, "w", zipfile.ZIP_DEFLATED, compresslevel=9) as archive:
+        for name, path in sorted(entries):
+            info = zipfile.ZipInfo(name, _ARCHIVE_TIMESTAMP)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = 0o644 << 16
+            with open(path, "rb") as file:
+                archive.writestr(info, file.read(), compresslevel=9)
+    return None
+
+
+def _build_ptm2(entries, archive_path, compression):
+    # PTM2 layout: a fixed header (magic, format version, flags, index length, data length), the zlib-compressed
+    # JSON index of every file (offset and size within the data section, compression, SHA-256), then each file
+    # compressed on its own, so any one of them can be fetched with a ranged read. Files that don't shrink are
+    # stored as they are.
+    files = []
+    with tempfile.TemporaryFile() as data:
+        for name, path in entries:
+            offset = data.tell()
+            compressor = _compressor(compression)
+            digest = hashlib.sha256()
+            size = 0
+            with open(path, "rb") as file:
+                for chunk in iter(lambda: file.read(_MAX_CHUNK_SIZE), b""):
+                    digest.update(chunk)
+                    size += len(chunk)
+                    data.write(compressor.compress(chunk))
+            data.write(compressor.flush())
+            method = compression
+            if data.tell() - offset >= size:
+                data.seek(offset)
+                data.truncate()
+                with open(path, "rb") as file:
+                    shutil.copyfileobj(file, data, _MAX_CHUNK_SIZE)
+                method = "none"
+            files.append({"name": name, "offset": offset, "size": size, "compressed_size": data.tell() - offset,
+                          "compression": method, "sha256": digest.hexdigest()})
+        index = zlib.compress(json.dumps({"files": files}, sort_keys=True, separators=(",", ":")).encode(), 9)
+        header = _PTM2_HEADER.pack(_PTM2_MAGIC, 2, 0, len(index), data.tell())
+        with open(archive_path, "wb") as archive:
+            archive.write(header)
+            archive.write(index)
+            data.seek(0)
+            shutil.copyfileobj(data, archive, _MAX_CHUNK_SIZE)
+    return hashlib.sha256(header + index).hexdigest()
+
+
+class _Progress:
+    # One byte-level progress bar shared by every package of a multi-package install.
+    def __init__(self, package_count):
+        from tqdm import tqdm
+
+        self._lock = threading.Lock()
+        # Inside `ptm daemon` the bar writes straight to its request's client, at the top line rather than stacked
+        # under the bars of other clients' commands.
+        client = _output.get()
+        self._stdout = _ClientOutput(client, "stdout") if client is not None else None
+        self._bar = tqdm(total=0, unit='iB', unit_scale=True, desc=f"{package_count} package(s)",
+                         file=_ClientOutput(client, "stderr") if client is not None else None,
+                         position=0 if client is not None else None)
+
+    def add_total(self, size):
+        with self._lock:
+            self._bar.total += size
+            self._bar.refresh()
+
+    def update(self, size):
+        with self._lock:
+            self._bar.update(size)
+
+    def write(self, message):
+        with self._lock:
+            self._bar.write(message, file=self._stdout)
+
+    def close(self):
+        self._bar.close()
+
+
+class _Span:
+    # Handle for a running span; `set` and `add` attach attributes (bytes, retries, cache hit/miss, ...). A span
+    # without a record belongs to a tracer that isn't recording, and ignores everything.
+    def __init__(self, record=None, lock=None):
+        self.record = record
+        self._lock = lock
+
+    def set(self, **attributes):
+        if self.record is not None:
+            self.record["attributes"].update(attributes)
+
+    def add(self, key, amount=1):
+        if self.record is not None:
+            with self._lock:
+                attributes = self.record["attributes"]
+                attributes[key] = attributes.get(key, 0) + amount
+
+
+class Tracer:
+    # Timed spans per package and phase (resolve, url, download, extract, install, upload, ...). Spans are kept only
+    # while tracing is enabled or a hook is registered, so an untraced run pays one check per phase. Hooks receive
+    # each finished span as a dict, on the thread that ran it.
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.hooks = []
+        self.spans = []
+        self.started = time.time()
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._ids = iter(range(1, sys.maxsize))
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    @contextlib.contextmanager
+    def span(self, phase, package=None, **attributes):
+        if not self.enabled and not self.hooks:
+            yield _Span()
+            return
+        stack = self._local.__dict__.setdefault("stack", [])
+        with self._lock:
+            span_id = next(self._ids)
+        record = {"id": span_id, "parent": stack[-1] if stack else None, "phase": phase, "package": package,
+                  "thread": threading.current_thread().name, "start": time.perf_counter() - self._origin,
+                  "duration": None, "error": None, "attributes": attributes}
+        stack.append(span_id)
+        try:
+            yield _Span(record, self._lock)
+        except BaseException as e:
+            record["error"] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            stack.pop()
+            record["duration"] = time.perf_counter() - self._origin - record["start"]
+            if record["attributes"].get("bytes") and record["duration"] > 0:
+                record["attributes"]["throughput"] = record["attributes"]["bytes"] / record["duration"]
+            if self.enabled:
+                with self._lock:
+                    self.spans.append(record)
+            for hook in self.hooks:
+                try:
+                    hook(record)
+                except Exception as e:
+                    print(f"{Fore.YELLOW}Trace hook failed: {e}{Style.RESET_ALL}")
+
+    def phases(self):
+        phases = {}
+        for record in self.spans:
+            totals = phases.setdefault(record["phase"], {"count": 0, "duration": 0.0, "bytes": 0, "errors": 0})
+            totals["count"] += 1
+            totals["duration"] += record["duration"]
+            totals["bytes"] += record["attributes"].get("bytes", 0)
+            totals["errors"] += record["error"] is not None
+        return phases
+
+    def to_json(self, path, command=None):
+        _write_json_atomic(path, {
+            "version": 1,
+            "command": command,
+            "started": datetime.datetime.fromtimestamp(self.started, datetime.timezone.utc).isoformat(),
+            "duration": time.perf_counter() - self._origin,
+            "phases": self.phases(),
+            "spans": sorted(self.spans, key=lambda record: record["id"]),
+        })
+
+    def summary(self):
+        packages = {}
+        for record in self.spans:
+            if record["package"] is None:
+                continue
+            row = packages.setdefault(record["package"], {"bytes": 0, "retries": 0, "cache": "", "phases": {}})
+            row["phases"][record["phase"]] = row["phases"].get(record["phase"], 0) + record["duration"]
+            row["bytes"] += record["attributes"].get("bytes", 0)
+            row["retries"] += record["attributes"].get("retries", 0)
+            row["cache"] = record["attributes"].get("cache", row["cache"])
+
+        lines = [f"{Fore.LIGHTWHITE_EX}{'Phase':<12} {'Count':>6} {'Total':>10} {'Bytes':>12} {'Throughput':>12}"
+                 f"{Style.RESET_ALL}"]
+        for phase, totals in self.phases().items():
+            throughput = f"{totals['bytes'] / totals['duration'] / 1024 ** 2:.1f} MiB/s" \
+                if totals["bytes"] and totals["duration"] else ""
+            lines.append(f"{phase:<12} {totals['count']:>6} {totals['duration']:>9.3f}s {totals['bytes']:>12} "
+                         f"{throughput:>12}")
+        if packages:
+            phases = list(dict.fromkeys(phase for row in packages.values() for phase in row["phases"]))
+            lines.append("")
+            lines.append(f"{Fore.LIGHTWHITE_EX}{'Package':<24}" + "".join(f" {phase:>10}" for phase in phases) +
+                         f" {'Bytes':>12} {'Cache':>6} {'Retries':>8}{Style.RESET_ALL}")
+            for package_name, row in sorted(packages.items()):
+                lines.append(f"{package_name:<24}" + "".join(
+                    f" {row['phases'][phase]:>9.3f}s" if phase in row["phases"] else f" {'':>10}" for phase in phases)
+                    + f" {row['bytes']:>12} {row['cache']:>6} {row['retries']:>8}")
+        return "\n".join(lines)
+
+
+def _load_trace_hook(spec):
+    # TRACE_HOOK names a callable as `module:function`, for wrappers that forward spans to their own metrics.
+    import importlib
+
+    module_name, _, attribute = spec.partition(":")
+    return getattr(importlib.import_module(module_name), attribute)
 
 
 class ProtoCSSPackageManager:
-    def __init__(self, server_url):
-        self.server_url = server_url
-        self.package_dir = "ptm_package"
-        self.installed_packages_dir = "modules"
+    def __init__(self, server_url, jobs=None, cache_size=None, tracer=None, root="", link_mode=None):
+        self.server_url = server_url or _config("REGISTRY_URL", "")
+        self.jobs = jobs or os.cpu_count() or 1
+        self.cache = PackageCache(max_size=cache_size)
+        self.store = ContentStore(_config("STORE_DIR") or os.path.join(self.cache.root, "store"))
+        self.link_mode = link_mode or _config("LINK_MODE", "none")
+        self.storage = _storage_backend(self.server_url)
+        self.registry = RegistryIndex(self.cache.root, self.storage, self.server_url)
+        self.metadata = MetadataCache(self.cache.root, self.server_url)
+        self.tracer = tracer or Tracer()
+        self._set_root(root)
+        self._downloader = None
+        self._downloader_lock = threading.Lock()
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+
+    def _set_root(self, root):
+        # ptm_package, modules and ptm.lock live in the project directory `root` (the working directory when empty).
+        self.root = root
+        self.package_dir = os.path.join(root, "ptm_package")
+        self.installed_packages_dir = os.path.join(root, "modules")
+        self.lockfile_path = os.path.join(root, "ptm.lock")
+        self.state = InstalledState(self.installed_packages_dir)
+        self.symbols = SymbolIndex(self.installed_packages_dir)
+        self._swap_thread_lock = threading.Lock()
+
+    def for_project(self, root, jobs=None, tracer=None, link_mode=None):
+        # A manager for the project in `root` that shares this one's storage client, connection pool, registry
+        # index, metadata cache and in-flight downloads. `ptm daemon` serves every project this way.
+        manager = copy.copy(self)
+        manager._downloader = self.downloader
+        manager._set_root(root)
+        manager.jobs = jobs or self.jobs
+        manager.tracer = tracer or Tracer()
+        manager.link_mode = link_mode or self.link_mode
+        return manager
+
+    @property
+    def downloader(self):
+        with self._downloader_lock:
+            if self._downloader is None:
+                self._downloader = _Downloader(headers=self.storage.download_headers())
+            return self._downloader
 
     def initialize(self):
         if not os.path.exists(self.package_dir):
@@ -81,195 +2174,894 @@ class ProtoCSSPackageManager:
     #         print(e)
 
     def install_package(self, *packages, **kwargs):
+        upgrade = kwargs.get("upgrade", False)
         try:
-            for package in packages:
-                # look for package in server
-                package_name = package
-                package_version = self.get_package_info(package_name)["version"]
-                print(f"{Fore.LIGHTYELLOW_EX}Installing package '{package_name}'...{Style.RESET_ALL}")
-                package = f"{package_name}-{package_version.replace('.', '_')}.ptm"
-                print(f"{Fore.YELLOW}Package found.{Style.RESET_ALL}")
-                print(f"{Fore.LIGHTYELLOW_EX}Downloading package '{package}'...{Style.RESET_ALL}")
+            with self.tracer.span("resolve") as span:
+                plan, failures = self._plan_install(packages, upgrade)
+                span.set(packages=len(plan))
+        except Exception as e:
+            print(f"\n      {Back.LIGHTRED_EX}{Fore.LIGHTWHITE_EX}      Error resolving packages!      {Style.RESET_ALL}\n")
+            print(e)
+            return {package_spec: e for package_spec in packages} or {"": e}
+        # `only` narrows the packages named on the command line to the matching files; dependencies stay whole.
+        only = {package_name: list(kwargs["only"]) for package_name, _ in map(_split_spec, packages)
+                if kwargs.get("only") and package_name in plan}
+        installed = self.state.packages()
+        for package_name in list(plan):
+            entry = installed.get(package_name)
+            if (entry is not None and entry["version"] == plan[package_name]["version"]
+                    and entry.get("sha256") == plan[package_name].get("sha256", entry.get("sha256"))
+                    and entry.get("only") == only.get(package_name)
+                    and entry.get("link", "none" if entry.get("store") is None else None) ==
+                    (self.link_mode if self._uses_store(only.get(package_name)) else "none")
+                    and os.path.isdir(os.path.join(self.installed_packages_dir, package_name))):
+                print(f"{Fore.YELLOW}Package '{package_name}' is already satisfied ({entry['version']}).{Style.RESET_ALL}")
+                del plan[package_name]
+        for package_name, error in failures.items():
+            print(
+                f"\n      {Back.LIGHTRED_EX}{Fore.LIGHTWHITE_EX}      Error resolving package '{package_name}'!      {Style.RESET_ALL}\n")
+            print(error)
+        failures.update(self._install_plan(plan, kwargs.get("jobs") or self.jobs, only))
+        return failures
 
-                if not os.path.exists(self.installed_packages_dir):
-                    os.mkdir(self.installed_packages_dir)
-                if not os.path.exists(os.path.join(self.installed_packages_dir, package_name)):
-                    os.mkdir(os.path.join(self.installed_packages_dir, package_name))
+    def _plan_install(self, packages, upgrade=False):
+        # Returns the releases to install keyed by package name (the requested packages and everything they depend
+        # on), and the requested packages that could not be resolved. A lockfile is used as-is when it already
+        # covers the request; otherwise the graph is resolved against the registry index (keeping locked versions
+        # where they still fit) and the lockfile is rewritten.
+        lock = self._read_lockfile()
+        requested = dict(_split_spec(package_spec) for package_spec in packages)
+        if not requested:
+            if lock is not None and not upgrade:
+                return lock["packages"], {}
+            requested = dict(lock["requires"]) if lock is not None else self._project_dependencies()
+            if not requested:
+                return {}, {}
 
-                blob = storage.bucket().blob(
-                    f"packages/{package_name}/{package_version.replace('.', '_')}/{package}")
+        requires = dict(lock["requires"]) if lock is not None else {}
+        if lock is not None and not upgrade and all(
+                package_name in lock["packages"] and (package_range is None or requires.get(package_name) == package_range)
+                for package_name, package_range in requested.items()):
+            return self._dependency_closure(lock["packages"], requested), {}
 
-                # Create URL for the blob
-                url = blob.generate_signed_url(datetime.timedelta(minutes=5))
+        for package_name, package_range in requested.items():
+            requires[package_name] = package_range or requires.get(package_name) or "*"
+        # Locked versions are kept where they still fit; an upgrade only lets the named packages move (or all of
+        # them when none are named).
+        preferred = {} if lock is None else {
+            package_name: release["version"] for package_name, release in lock["packages"].items()
+            if not upgrade or (packages and package_name not in requested)}
+        resolved, failures = self._resolve_roots(requires, preferred, requested)
+        self._write_lockfile({package_name: package_range for package_name, package_range in requires.items()
+                              if package_name not in failures}, resolved)
+        return self._dependency_closure(resolved, requested), failures
 
-                # Stream the download while updating the progress bar
-                response = requests.get(url, stream=True)
-                total_size_in_bytes = int(response.headers.get('content-length', 0))
-                progress_bar = tqdm(total=total_size_in_bytes, unit='iB', unit_scale=True)
+    def _resolve_roots(self, requires, preferred, roots):
+        # Resolves the graph as a whole. If that fails, the roots that can't be resolved even on their own are left
+        # out and returned as failures, so one missing package doesn't stop the others from installing.
+        try:
+            return self.resolve_dependencies(requires, preferred), {}
+        except LookupError:
+            failures = {}
+            for package_name in roots:
+                try:
+                    self.resolve_dependencies({package_name: requires[package_name]}, preferred)
+                except LookupError as e:
+                    failures[package_name] = e
+            if not failures:
+                raise
+        remaining = {package_name: package_range for package_name, package_range in requires.items()
+                     if package_name not in failures}
+        return (self.resolve_dependencies(remaining, preferred) if remaining else {}), failures
 
-                with open(os.path.join(f"{self.installed_packages_dir}/{package_name}/", package), 'wb') as file:
-                    for chunk in response.iter_content(chunk_size=1024):
-                        progress_bar.update(len(chunk))
-                        file.write(chunk)
-                progress_bar.close()
-                if total_size_in_bytes != 0 and progress_bar.n != total_size_in_bytes:
-                    print("ERROR, something went wrong")
+    def resolve_dependencies(self, requires, preferred=None):
+        # Picks one version per package so that every range in the graph is satisfied, preferring `preferred`
+        # versions and otherwise the newest. Everything comes from the local registry index, so this is one pass
+        # with no network round-trips per package.
+        preferred = preferred or {}
+        constraints = {package_name: {None: package_range} for package_name, package_range in requires.items()}
+        selected = {}
+        pending = collections.deque(requires)
+        for _ in range(10000):
+            if not pending:
+                break
+            package_name = pending.popleft()
+            ranges = constraints.get(package_name)
+            if not ranges:
+                continue
+            releases = self._releases(package_name)
+            candidates = [version for version in releases if all(_satisfies(version, r) for r in ranges.values())]
+            if not candidates:
+                wanted = ", ".join(f"{requester or 'project'} wants {r}" for requester, r in ranges.items())
+                raise LookupError(f"No version of '{package_name}' satisfies all requirements ({wanted}).")
+            if preferred.get(package_name) in candidates:
+                version = preferred[package_name]
+            else:
+                version = max(candidates, key=_version_key)
+            previous = selected.get(package_name)
+            if previous is not None and previous["version"] == version:
+                continue
+            if previous is not None:
+                for dependency in previous.get("dependencies", {}):
+                    constraints[dependency].pop(package_name, None)
+                    pending.append(dependency)
+            selected[package_name] = releases[version]
+            for dependency, dependency_range in releases[version].get("dependencies", {}).items():
+                constraints.setdefault(dependency, {})[package_name] = dependency_range
+                pending.append(dependency)
+        else:
+            raise LookupError("Dependency resolution did not settle.")
+        return self._dependency_closure(selected, requires)
+
+    def _releases(self, package_name):
+        package = self.registry.packages().get(package_name)
+        if package is not None:
+            return {version: dict(release, name=package_name, version=version)
+                    for version, release in package["versions"].items()}
+        release = self._legacy_release(package_name)
+        return {release["version"]: release}
+
+    def _legacy_release(self, package_name):
+        # Packages published before the registry index existed are only described by their package.json.
+        package_info = self._fetch_package_info(package_name)
+        if package_info is None:
+            raise LookupError(f"Package '{package_name}' not found.")
+        return {"name": package_name, "version": package_info["version"].replace("_", "."),
+                "dependencies": package_info.get("dependencies", {})}
+
+    @staticmethod
+    def _dependency_closure(releases, roots):
+        closure = {}
+        pending = [package_name for package_name in roots if package_name in releases]
+        while pending:
+            package_name = pending.pop()
+            if package_name not in closure:
+                closure[package_name] = releases[package_name]
+                pending.extend(d for d in releases[package_name].get("dependencies", {}) if d in releases)
+        return closure
 
-                print(f"{Fore.YELLOW}Package downloaded.{Style.RESET_ALL}")
+    def _project_dependencies(self):
+        try:
+            with open(os.path.join(self.package_dir, "package.json")) as file:
+                return json.load(file).get("dependencies", {})
+        except (OSError, ValueError):
+            return {}
 
-                shutil.move(os.path.join(f"{self.installed_packages_dir}/{package_name}/", package),
-                            os.path.join(f"{self.installed_packages_dir}/{package_name}/",
-                                         f"{package_name}-{package_version.replace('.', '_')}.zip"))
+    def _read_lockfile(self):
+        try:
+            with open(self.lockfile_path) as file:
+                lock = json.load(file)
+        except (OSError, ValueError):
+            return None
+        return lock if lock.get("lockfileVersion") == 1 else None
 
-                print(f"{Fore.LIGHTYELLOW_EX}Unzipping package '{package}'...{Style.RESET_ALL}")
-                package_zip = f"{package_name}-{package_version.replace('.', '_')}.zip"
-                shutil.unpack_archive(os.path.join(f"{self.installed_packages_dir}/{package_name}", package_zip),
-                                      self.installed_packages_dir + f"/{package_name}")
+    def _write_lockfile(self, requires, releases):
+        _write_json_atomic(self.lockfile_path, {
+            "lockfileVersion": 1,
+            "requires": requires,
+            "packages": releases,
+        })
 
-                print(f"{Fore.YELLOW}Package unzipped.{Style.RESET_ALL}")
+    def _install_plan(self, plan, jobs, only=None):
+        import concurrent.futures
 
-                os.remove(os.path.join(self.installed_packages_dir + f"/{package_name}", package_zip))
-                os.remove(os.path.join(self.installed_packages_dir + f"/{package_name}",
-                                       f"{package_name}-{package_version.replace('.', '_')}_.ptm"))
-                print(f"{Fore.YELLOW}Leftover files removed.{Style.RESET_ALL}")
+        if not plan:
+            return {}
+        if not os.path.exists(self.installed_packages_dir):
+            os.mkdir(self.installed_packages_dir)
+        self._recover_swaps()
 
-                print(
-                    f"\n      {Back.LIGHTGREEN_EX}{Fore.LIGHTWHITE_EX}      Package '{package_name}' installed successfully!      {Style.RESET_ALL}\n")
-        except Exception as e:
+        # Downloads run on a bounded pool and unpack while the bytes arrive. Cached archives are unpacked on the
+        # extraction pool. A package is swapped into place only after the packages it depends on, so modules/
+        # never holds a package whose dependencies are missing; if a dependency fails, its dependents fail too.
+        dependencies = {package_name: [d for d in release.get("dependencies", {}) if d in plan]
+                        for package_name, release in plan.items()}
+        progress = _Progress(len(plan))
+        failures = {}
+        installed = []
+        downloaded = {}
+        with _thread_pool(jobs) as download_pool, _thread_pool(jobs) as extract_pool:
+            running = {download_pool.submit(self._download_package, package_name, release, progress,
+                                            (only or {}).get(package_name)):
+                       (package_name, "download") for package_name, release in plan.items()}
+            while running or downloaded:
+                if running:
+                    done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        package_name, stage = running.pop(future)
+                        try:
+                            result = future.result()
+                        except Exception as e:
+                            failures[package_name] = e
+                            continue
+                        if stage == "extract":
+                            installed.append(package_name)
+                        else:
+                            downloaded[package_name] = result
+
+                ready = {}
+                changed = True
+                while changed:
+                    changed = False
+                    for package_name in list(downloaded):
+                        blocking = [d for d in dependencies[package_name] if d not in installed]
+                        failed = [d for d in blocking if d in failures]
+                        if failed:
+                            with self.tracer.span("cleanup", package_name):
+                                self._discard_download(downloaded.pop(package_name))
+                            failures[package_name] = LookupError(f"Dependency '{failed[0]}' could not be installed.")
+                            changed = True
+                        elif not blocking:
+                            ready[package_name] = downloaded.pop(package_name)
+                if not running and not ready:
+                    # Only dependency cycles are left; they can't be ordered, so install them together.
+                    ready, downloaded = downloaded, {}
+                for package_name, download in ready.items():
+                    running[extract_pool.submit(self._extract_package, package_name, download, progress)] = \
+                        (package_name, "extract")
+        progress.close()
+        if installed:
+            try:
+                with self.tracer.span("symbols") as span:
+                    span.set(files=self.symbols.update(self.state.packages()))
+            except Exception as e:
+                print(f"{Fore.YELLOW}Could not update the symbol index: {e}{Style.RESET_ALL}")
+
+        for package_name in installed:
+            print(
+                f"\n      {Back.LIGHTGREEN_EX}{Fore.LIGHTWHITE_EX}      Package '{package_name}' installed successfully!      {Style.RESET_ALL}\n")
+        for package_name, error in failures.items():
             print(
                 f"\n      {Back.LIGHTRED_EX}{Fore.LIGHTWHITE_EX}      Error installing package '{package_name}'!      {Style.RESET_ALL}\n")
-            print(e)
+            print(error)
+        return failures
+
+    def _download_package(self, package_name, release, progress, only=None):
+        if "sha256" not in release and release.get("version") is None:
+            with self.tracer.span("info", package_name):
+                release = self._legacy_release(package_name)
+        if not self.cache.enabled:
+            return self._fetch_release(package_name, release, progress, only)
+        with self._single_flight((package_name, release["version"], release.get("sha256"))):
+            return self._fetch_release(package_name, release, progress, only)
+
+    @contextlib.contextmanager
+    def _single_flight(self, key):
+        # Downloads of the same archive (parallel builds served by one `ptm daemon`) run one at a time. The first
+        # leaves the archive in the cache, so the others find it there instead of downloading it again.
+        with self._inflight_lock:
+            flight = self._inflight.setdefault(key, [threading.Lock(), 0])
+            flight[1] += 1
+        try:
+            with flight[0]:
+                yield
+        finally:
+            with self._inflight_lock:
+                flight[1] -= 1
+                if not flight[1]:
+                    del self._inflight[key]
+
+    def _uses_store(self, only=None):
+        # With a link mode, whole packages are unpacked once into the content store and linked into modules/.
+        return self.link_mode != "none" and only is None
+
+    def _fetch_release(self, package_name, release, progress, only=None):
+        package_version = release["version"]
+        package = f"{package_name}-{package_version.replace('.', '_')}.ptm"
+
+        if self._uses_store(only) and release.get("sha256"):
+            with self.tracer.span("store", package_name) as span:
+                store_path = self.store.get(package_name, package_version, release["sha256"])
+                span.set(store="hit" if store_path is not None else "miss")
+            if store_path is not None:
+                progress.write(f"{Fore.YELLOW}Package '{package}' found in the store.{Style.RESET_ALL}")
+                return {"version": package_version, "archive_path": None, "partial_dir": None,
+                        "store_path": store_path, "sha256": release["sha256"], "only": None}
+
+        if self.cache.enabled:
+            with self.tracer.span("cache", package_name) as span:
+                cached_path = self.cache.get(package_name, package_version, sha256=release.get("sha256"))
+                span.set(cache="hit" if cached_path is not None else "miss")
+            if cached_path is not None:
+                progress.write(f"{Fore.YELLOW}Package '{package}' found in cache.{Style.RESET_ALL}")
+                # Claims are named `.<sha256>.<...>.claim`.
+                return {"version": package_version, "archive_path": cached_path, "partial_dir": None,
+                        "sha256": os.path.basename(cached_path).split(".")[1], "remove_archive": True,
+                        "only": only}
 
-    def upload_package(self):
-        try:
-            if not os.path.exists(os.path.join(self.package_dir, "package.json")):
-                print(
-                    f"\n      {Back.LIGHTYELLOW_EX}{Fore.LIGHTWHITE_EX}      package.json not found      {Style.RESET_ALL}\n")
-
-                package_name = input("Package name: ")
-                package_description = input("Package description: ")
-                package_author = input("Package author: ")
-                package_version = input("Package version: ")
-                package_file_name = f"{package_name}-{package_version}.ptm"
-                package_file_path = os.path.join(self.package_dir, package_file_name)
-
-                with open(os.path.join(os.path.abspath(self.package_dir), "package.json"), "w") as file:
-                    file.write(f"""{{
-        "name": "{package_name}",
-        "description": "{package_description}",
-        "author": "{package_author}",
-        "version": "{package_version}"
-    }}""")
-                with open(os.path.join(self.package_dir, "package.json")) as file:
-                    package_info = file.read()
-
-                package_name = package_info.split('"name": "')[1].split('"')[0]
-                package_version = package_info.split('"version": "')[1].split('"')[0].replace(".", "_")
-                package_author = package_info.split('"author": "')[1].split('"')[0]
-                package_file_name = f"{package_name}-{package_version}.ptm"
-                package_file_path = os.path.join(self.package_dir, package_file_name)
-                print("Uploading package...")
-                print(f"\n{Fore.LIGHTWHITE_EX}Name:{Style.RESET_ALL} {package_name}")
-                print(f"{Fore.LIGHTWHITE_EX}Version:{Style.RESET_ALL} {package_version.replace('_', '.')}")
-                print(f"{Fore.LIGHTWHITE_EX}Author:{Style.RESET_ALL} {package_author}\n")
-                # print(f"{Fore.LIGHTWHITE_EX}package_file_name:{Style.RESET_ALL} {package_file_name}\n")
-
-                if os.path.exists(package_file_path):
-                    os.remove(package_file_path)
-                    print(f"{Fore.LIGHTYELLOW_EX}Last version removed.{Style.RESET_ALL}\n")
-
-                print(f"{Fore.LIGHTYELLOW_EX}Creating new version of '{package_name}'...{Style.RESET_ALL}")
-                output_path = os.path.abspath("ptm_package")
-                # print(f"{Fore.LIGHTYELLOW_EX}output_path: {output_path}{Style.RESET_ALL}")
-                shutil.make_archive(f"{package_name}-{package_version}", "zip", output_path)
-                print(f"{Fore.YELLOW}New version created.{Style.RESET_ALL}")
-                # print(os.path.join(self.package_dir, f"{package_name}-{package_version}.zip"))
-                shutil.move(os.path.abspath(f"./{package_name}-{package_version}.zip"), package_file_path)
-                print(f"{Fore.YELLOW}New version moved.{Style.RESET_ALL}")
-                blob = storage.bucket().blob(f"packages/{package_file_name}")
-                print(f"{Fore.LIGHTYELLOW_EX}Uploading new version...{Style.RESET_ALL}")
-                blob.upload_from_filename(package_file_path)
-                print(
-                    f"\n      {Back.LIGHTGREEN_EX}{Fore.LIGHTWHITE_EX}      Package '{package_name}' uploaded successfully!      {Style.RESET_ALL}\n")
+        progress.write(f"{Fore.LIGHTYELLOW_EX}Downloading package '{package}'...{Style.RESET_ALL}")
 
+        with self.tracer.span("url", package_name):
+            url = self.storage.url(
+                release.get("path") or f"packages/{package_name}/{package_version.replace('.', '_')}/{package}")
+
+        size = release.get("size")
+        sha256 = release.get("sha256")
+        if only is not None and release.get("index_sha256") and size:
+            with self.tracer.span("download", package_name, version=package_version, mode="ranges") as span:
+                return self._download_selected(package_name, release, url, only, progress, span)
+        if self.cache.enabled:
+            staging_path = self.cache.staging_path(package, sha256)
+        else:
+            os.makedirs(self.installed_packages_dir, exist_ok=True)
+            staging_path = os.path.join(self.installed_packages_dir,
+                                        f".{package}.{os.getpid()}.{threading.get_ident()}.part")
+        with _claim_file(staging_path) as (staging_path, staging_file), \
+                self.tracer.span("download", package_name, version=package_version) as span:
+            if size and size >= self.downloader.segment_threshold:
+                span.set(mode="segments")
+                return self._download_segmented(package_name, package_version, package, url, staging_path,
+                                                 size, sha256, progress, span, only)
+            span.set(mode="stream")
+            return self._download_streaming(package_name, package_version, package, url, staging_path,
+                                            staging_file, size, sha256, progress, span, only)
+
+    def _download_selected(self, package_name, release, url, only, progress, span):
+        # Reads the PTM2 header and index, then only the byte ranges of the files matching `only`, with neighbouring
+        # files merged into one request. The index is checked against the hash the registry keeps for it, and each
+        # file against the index. Partial packages aren't cached.
+        head = bytearray()
+        self.downloader.stream(url, head.extend, 0, min(release["size"], 64 * 1024))
+        parsed = _parse_ptm2_index(head)
+        if parsed is None:
+            index_end = _PTM2_HEADER.size + _PTM2_HEADER.unpack_from(head)[3]
+            self.downloader.stream(url, head.extend, len(head), index_end)
+            parsed = _parse_ptm2_index(head)
+        index, data_offset, _ = parsed
+        if hashlib.sha256(head[:data_offset]).hexdigest() != release["index_sha256"]:
+            raise IOError(f"Index of '{package_name}' does not match the registry index.")
+
+        partial_dir = self._partial_dir(package_name)
+        extractor = _Ptm2StreamExtractor(partial_dir, only, index)
+        ranges = []
+        for entry in extractor.selected():
+            end = entry["offset"] + entry["compressed_size"]
+            if ranges and entry["offset"] - ranges[-1][1] <= _RANGE_MERGE_GAP:
+                ranges[-1][1] = max(ranges[-1][1], end)
             else:
-                print(
-                    f"\n      {Back.LIGHTBLUE_EX}{Fore.LIGHTWHITE_EX}      package.json found      {Style.RESET_ALL}\n")
-
-                with open(os.path.join(self.package_dir, "package.json")) as file:
-                    package_info = file.read()
-
-                package_name = package_info.split('"name": "')[1].split('"')[0]
-                package_version = package_info.split('"version": "')[1].split('"')[0].replace(".", "_")
-                package_author = package_info.split('"author": "')[1].split('"')[0]
-                package_file_name = f"{package_name}-{package_version}.ptm"
-                package_file_path = os.path.join(self.package_dir, package_file_name)
-                print("Uploading package...")
-                print(f"\n{Fore.LIGHTWHITE_EX}Name:{Style.RESET_ALL} {package_name}")
-                print(f"{Fore.LIGHTWHITE_EX}Version:{Style.RESET_ALL} {package_version.replace('_', '.')}")
-                print(f"{Fore.LIGHTWHITE_EX}Author:{Style.RESET_ALL} {package_author}\n")
-                # print(f"{Fore.LIGHTWHITE_EX}package_file_name:{Style.RESET_ALL} {package_file_name}\n")
-
-                if os.path.exists(package_file_path):
-                    os.remove(package_file_path)
-                    print(f"{Fore.LIGHTYELLOW_EX}Last version removed.{Style.RESET_ALL}\n")
-
-                print(f"{Fore.LIGHTYELLOW_EX}Creating new version of '{package_name}'...{Style.RESET_ALL}")
-                output_path = os.path.abspath("ptm_package")
-                # print(f"{Fore.LIGHTYELLOW_EX}output_path: {output_path}{Style.RESET_ALL}")
-                shutil.make_archive(f"{package_name}-{package_version}", "zip", output_path)
-                print(f"{Fore.YELLOW}New version created.{Style.RESET_ALL}")
-                # print(os.path.join(self.package_dir, f"{package_name}-{package_version}.zip"))
-                shutil.move(os.path.abspath(f"./{package_name}-{package_version}.zip"), package_file_path)
-                print(f"{Fore.YELLOW}New version moved.{Style.RESET_ALL}")
-                # blob = storage.bucket().blob(f"packages/{package_name}/{package_version}/{package_file_name}")
-                # blob = storage.bucket().blob(f"packages/{package_name}/{package_version}/package.json")
-                print(f"{Fore.LIGHTYELLOW_EX}Uploading new version...{Style.RESET_ALL}")
-                for upload in [package_file_path, os.path.join(self.package_dir, "package.json")]:
-                    storage.bucket().blob(
-                        f"packages/{package_name}/{package_version}/{upload.split('/')[-1]}").upload_from_filename(
-                        upload)
-                print(
-                    f"\n      {Back.LIGHTGREEN_EX}{Fore.LIGHTWHITE_EX}      Package '{package_name}' uploaded successfully!      {Style.RESET_ALL}\n")
+                ranges.append([entry["offset"], end])
+        # Small packages arrive whole with the first read.
+        remote = [(begin, end) for begin, end in ranges if data_offset + end > len(head)]
+        progress.add_total(len(head) + sum(end - begin for begin, end in remote))
+        progress.update(len(head))
+        span.add("bytes", len(head))
 
-        except Exception as e:
-            print(f"{Fore.RED}Error: {e}{Style.RESET_ALL}")
+        def consume(chunk):
+            progress.update(len(chunk))
+            span.add("bytes", len(chunk))
+            extractor.feed(chunk)
+
+        try:
+            for begin, end in ranges:
+                extractor.seek(begin)
+                if (begin, end) in remote:
+                    self.downloader.stream(url, consume, data_offset + begin, data_offset + end,
+                                           on_retry=lambda: span.add("retries"))
+                else:
+                    extractor.feed(bytes(head[data_offset + begin:data_offset + end]))
+            extractor.close()
+        except BaseException:
+            shutil.rmtree(partial_dir, ignore_errors=True)
+            raise
+        span.set(files=len(extractor.files), ranges=len(ranges))
+        progress.write(f"{Fore.YELLOW}Package '{package_name}' downloaded and unpacked "
+                       f"({len(extractor.files)} of {len(index['files'])} files).{Style.RESET_ALL}")
+        return {"version": release["version"], "archive_path": None, "partial_dir": partial_dir,
+                "sha256": release["sha256"], "files": extractor.files, "only": only}
+
+    def _download_streaming(self, package_name, package_version, package, url, staging_path, staging_file, size,
+                            sha256, progress, span, only):
+        # Stream the download straight into the extractor, hashing it and teeing it into the cache on the way. A
+        # partial file left by an earlier run is replayed first and the transfer resumes where it stopped.
+        if size:
+            progress.add_total(size)
+        partial_dir = self._partial_dir(package_name, store=self._uses_store(only))
+        extractor = _PackageExtractor(partial_dir, only)
+        digest = hashlib.sha256()
+        keep_file = self.cache.enabled
+
+        def consume(chunk):
+            progress.update(len(chunk))
+            span.add("bytes", len(chunk))
+            digest.update(chunk)
+            if keep_file:
+                staging_file.write(chunk)
+            extractor.feed(chunk)
+
+        try:
+            staging_file.seek(0)
+            resumed = 0
+            if keep_file and sha256 is not None:
+                for chunk in iter(lambda: staging_file.read(_MAX_CHUNK_SIZE), b""):
+                    resumed += len(chunk)
+                    progress.update(len(chunk))
+                    digest.update(chunk)
+                    extractor.feed(chunk)
+            staging_file.truncate(resumed)
+            span.set(resumed=resumed)
+            received = self.downloader.stream(url, consume, resumed, size, on_retry=lambda: span.add("retries"))
+            if size and received != size:
+                raise IOError(f"Download of '{package}' is incomplete ({received} of {size} bytes).")
+            if sha256 is not None and digest.hexdigest() != sha256:
+                staging_file.truncate(0)
+                raise IOError(f"Checksum of '{package}' does not match the registry index.")
+            extractor.close()
+            staging_file.flush()
+            if keep_file:
+                self.cache.put(package_name, package_version, staging_path, sha256=digest.hexdigest())
+        except BaseException as e:
+            self._remove_partial(partial_dir)
+            if not isinstance(e, (_TransferInterrupted, KeyboardInterrupt)):
+                # Only a transfer that was cut off is worth resuming; anything else means the bytes are bad.
+                staging_file.truncate(0)
+            raise
+        finally:
+            if not keep_file:
+                _remove_quietly(staging_path)
+
+        progress.write(f"{Fore.YELLOW}Package '{package_name}' downloaded and unpacked.{Style.RESET_ALL}")
+        return {"version": package_version, "archive_path": None, "partial_dir": partial_dir,
+                "sha256": digest.hexdigest(), "files": extractor.files, "only": only}
+
+    def _download_segmented(self, package_name, package_version, package, url, staging_path, size, sha256,
+                            progress, span, only):
+        # Large archives are fetched over parallel ranged connections into the staging file, verified, and then
+        # unpacked from disk on the extraction pool.
+        progress.add_total(size)
+
+        def on_progress(amount):
+            progress.update(amount)
+            span.add("bytes", amount)
+
+        self.downloader.fetch_segments(url, staging_path, size, on_progress, on_retry=lambda: span.add("retries"))
+        actual_sha256 = _sha256_file(staging_path)
+        if sha256 is not None and actual_sha256 != sha256:
+            _remove_quietly(staging_path)
+            raise IOError(f"Checksum of '{package}' does not match the registry index.")
+        progress.write(f"{Fore.YELLOW}Package '{package_name}' downloaded.{Style.RESET_ALL}")
+        if self.cache.enabled:
+            archive_path = self.cache.put(package_name, package_version, staging_path, sha256=actual_sha256,
+                                          claim=True)
+            return {"version": package_version, "archive_path": archive_path, "partial_dir": None,
+                    "sha256": actual_sha256, "remove_archive": True, "only": only}
+        return {"version": package_version, "archive_path": staging_path, "partial_dir": None,
+                "sha256": actual_sha256, "remove_archive": True, "only": only}
+
+    def _discard_download(self, download):
+        if download["partial_dir"] is not None:
+            self._remove_partial(download["partial_dir"])
+        if download.get("remove_archive"):
+            _remove_quietly(download["archive_path"])
+
+    def _extract_package(self, package_name, download, progress):
+        partial_dir = download["partial_dir"]
+        files = download.get("files")
+        store = self._uses_store(download.get("only"))
+        if partial_dir is None and download.get("store_path") is None:
+            progress.write(f"{Fore.LIGHTYELLOW_EX}Unzipping package '{package_name}'...{Style.RESET_ALL}")
+            partial_dir = self._partial_dir(package_name, store=store)
+            try:
+                with self.tracer.span("extract", package_name) as span:
+                    extractor = _PackageExtractor(partial_dir, download.get("only"))
+                    with open(download["archive_path"], "rb") as file:
+                        for chunk in iter(lambda: file.read(_MAX_CHUNK_SIZE), b""):
+                            extractor.feed(chunk)
+                    extractor.close()
+                    span.set(files=len(extractor.files))
+            except BaseException:
+                self._remove_partial(partial_dir)
+                raise
+            finally:
+                if download.get("remove_archive"):
+                    _remove_quietly(download["archive_path"])
+            files = extractor.files
+        store_path = download.get("store_path")
+        if store:
+            with self.tracer.span("link", package_name) as span:
+                if store_path is None:
+                    store_path = self.store.add(package_name, download["version"], download["sha256"], partial_dir,
+                                                files)
+                partial_dir, files, method = self._link_from_store(package_name, store_path)
+                span.set(mode=method)
+        try:
+            with open(os.path.join(partial_dir, "package.json")) as file:
+                package_info = json.load(file)
+        except (OSError, ValueError):
+            package_info = {}
+        with self.tracer.span("install", package_name):
+            self._swap_into_place(package_name, partial_dir)
+            self.state.record(package_name, {
+                "version": download["version"],
+                "sha256": download["sha256"],
+                "description": package_info.get("description", ""),
+                "author": package_info.get("author", ""),
+                "dependencies": package_info.get("dependencies", {}),
+                "files": files,
+                "only": download.get("only"),
+                "store": os.path.basename(store_path) if store else None,
+                "link": self.link_mode if store else "none",
+                "installed_at": time.time(),
+            })
+        if store:
+            progress.write(f"{Fore.YELLOW}Package '{package_name}' linked from the store ({method}).{Style.RESET_ALL}")
+        else:
+            progress.write(f"{Fore.YELLOW}Package '{package_name}' unzipped.{Style.RESET_ALL}")
+
+    def _link_from_store(self, package_name, store_path):
+        # Returns the link to swap into modules/, its files as recorded in the installed state, and the link method.
+        self.store.register(self.installed_packages_dir)
+        os.makedirs(self.installed_packages_dir, exist_ok=True)
+        target = os.path.join(self.installed_packages_dir,
+                              f".{package_name}.partial-{os.getpid()}-{threading.get_ident()}")
+        try:
+            method = self.store.link(store_path, target, self.link_mode)
+        except BaseException:
+            _remove_path(target)
+            raise
+        # Copies and reflinks are new files, so their mtimes are the ones `ptm verify` has to compare against.
+        files = {}
+        for relative_path, recorded in self.store.manifest(store_path)["files"].items():
+            stat = os.stat(os.path.join(target, *relative_path.split("/")))
+            files[relative_path] = dict(recorded, mtime_ns=stat.st_mtime_ns)
+        return target, files, method
+
+    def _partial_dir(self, package_name, store=False):
+        # Staging directories live next to the final one so the swap is a rename on the same filesystem. Packages
+        # bound for the content store are staged inside the store instead.
+        if store:
+            return self.store.staging_dir(package_name)
+        os.makedirs(self.installed_packages_dir, exist_ok=True)
+        partial_dir = tempfile.mkdtemp(prefix=f".{package_name}.partial-{os.getpid()}-",
+                                       dir=self.installed_packages_dir)
+        os.chmod(partial_dir, 0o777 & ~_umask())
+        return partial_dir
+
+    def _remove_partial(self, partial_dir):
+        # Store staging directories hold the package in `package/` under their `.tmp-*` directory.
+        if os.path.dirname(os.path.dirname(partial_dir)) == self.store.root:
+            partial_dir = os.path.dirname(partial_dir)
+        shutil.rmtree(partial_dir, ignore_errors=True)
+
+    def _swap_lock(self):
+        return _locked_file(os.path.join(self.installed_packages_dir, ".ptm-swap.lock"), self._swap_thread_lock)
+
+    def _swap_into_place(self, package_name, partial_dir):
+        # Where renameat2(RENAME_EXCHANGE) works, the new copy and the old one trade places in a single step, so
+        # modules/<name> always exists. Elsewhere the old copy is moved aside to `.<name>.old-*` first; if the
+        # process dies before the new copy is renamed in, modules/<name> is missing until the next install moves
+        # the old copy back (_recover_swaps).
+        package_dir = os.path.join(self.installed_packages_dir, package_name)
+        with self._swap_lock():
+            if os.path.lexists(package_dir) and _exchange_paths(partial_dir, package_dir):
+                _remove_path(partial_dir)
+                return
+            old_dir = None
+            if os.path.lexists(package_dir):
+                old_dir = tempfile.mkdtemp(prefix=f".{package_name}.old-{os.getpid()}-",
+                                           dir=self.installed_packages_dir)
+                os.replace(package_dir, os.path.join(old_dir, package_name))
+            os.replace(partial_dir, package_dir)
+            if old_dir is not None:
+                shutil.rmtree(old_dir, ignore_errors=True)
+
+    def _recover_swaps(self):
+        # Cleans up after installs that died midway. `.old-*` directories only exist inside a swap, so under the
+        # swap lock any left over are orphans: their package is moved back if modules/<name> is missing and
+        # dropped otherwise. Staging directories, links and downloads are removed once the process that named
+        # them is gone.
+        with self._swap_lock():
+            for entry in os.listdir(self.installed_packages_dir):
+                match = re.fullmatch(r"\.(.+)\.(?:(old)-\d+|partial-(\d+))-.*|\..+\.(\d+)\.\d+\.part", entry)
+                if not match:
+                    continue
+                path = os.path.join(self.installed_packages_dir, entry)
+                if match.group(2):
+                    package_dir = os.path.join(self.installed_packages_dir, match.group(1))
+                    moved = os.path.join(path, match.group(1))
+                    if not os.path.lexists(package_dir) and os.path.lexists(moved):
+                        os.replace(moved, package_dir)
+                    _remove_path(path)
+                elif not _pid_alive(int(match.group(3) or match.group(4))):
+                    _remove_path(path)
+
+    def upload_package(self, *packages, **kwargs):
+        import concurrent.futures
+
+        # Prompting for missing package.json fields happens up front, one package at a time; building and uploading
+        # then run in parallel.
+        compression = kwargs.get("compression") or _config("PACKAGE_COMPRESSION", "zip")
+        if compression != "zip" and compression not in _PTM2_COMPRESSIONS:
+            raise ValueError(f"Unknown compression '{compression}' (expected zip, {', '.join(_PTM2_COMPRESSIONS)}).")
+        sources = {}
+        failures = {}
+        for package_name in packages or (None,):
+            try:
+                source_dir = self._upload_source(package_name)
+                package_info = self._ensure_package_json(source_dir)
+                sources[package_info["name"]] = (source_dir, package_info)
+            except Exception as e:
+                failures[package_name or self.package_dir] = e
+        if sources:
+            self.registry.refresh(force=True)
+        with _thread_pool(kwargs.get("jobs") or self.jobs) as pool:
+            uploads = {pool.submit(self._upload_one, source_dir, package_info, compression): package_name
+                       for package_name, (source_dir, package_info) in sources.items()}
+            uploaded = False
+            for future in concurrent.futures.as_completed(uploads):
+                try:
+                    uploaded = future.result() or uploaded
+                except Exception as e:
+                    failures[uploads[future]] = e
+        if uploaded:
+            # Pick up the releases just published so installs from this checkout see them right away.
+            self.registry.refresh(force=True)
+        for package_name, error in failures.items():
+            print(f"{Fore.RED}Error uploading '{package_name}': {error}{Style.RESET_ALL}")
+        return failures
+
+    def _upload_source(self, package_name):
+        # `ptm -up` uploads ptm_package itself; `ptm -up name` uploads ptm_package/<name>, or ptm_package when that
+        # is the package called `name`.
+        if package_name is None:
+            return self.package_dir
+        if os.path.isdir(os.path.join(self.package_dir, package_name)):
+            return os.path.join(self.package_dir, package_name)
+        try:
+            with open(os.path.join(self.package_dir, "package.json")) as file:
+                if json.load(file).get("name") == package_name:
+                    return self.package_dir
+        except (OSError, ValueError):
+            pass
+        raise LookupError(f"Package '{package_name}' not found.")
+
+    def _ensure_package_json(self, source_dir):
+        package_json_path = os.path.join(source_dir, "package.json")
+        if not os.path.exists(package_json_path):
+            print(
+                f"\n      {Back.LIGHTYELLOW_EX}{Fore.LIGHTWHITE_EX}      package.json not found      {Style.RESET_ALL}\n")
+
+            package_info = {
+                "name": input("Package name: "),
+                "description": input("Package description: "),
+                "author": input("Package author: "),
+                "version": input("Package version: "),
+            }
+            with open(package_json_path, "w") as file:
+                json.dump(package_info, file, indent=4)
+        else:
+            print(
+                f"\n      {Back.LIGHTBLUE_EX}{Fore.LIGHTWHITE_EX}      package.json found      {Style.RESET_ALL}\n")
+        with open(package_json_path) as file:
+            return json.load(file)
+
+    def _upload_one(self, source_dir, package_info, compression="zip"):
+        package_name = package_info["name"]
+        package_version = package_info["version"].replace("_", ".")
+        package_file_name = f"{package_name}-{package_version.replace('.', '_')}.ptm"
+        blob_dir = f"packages/{package_name}/{package_version.replace('.', '_')}"
+        print(f"\n{Fore.LIGHTWHITE_EX}Name:{Style.RESET_ALL} {package_name}")
+        print(f"{Fore.LIGHTWHITE_EX}Version:{Style.RESET_ALL} {package_version}")
+        print(f"{Fore.LIGHTWHITE_EX}Author:{Style.RESET_ALL} {package_info.get('author', '')}\n")
+
+        with tempfile.TemporaryDirectory() as build_dir:
+            print(f"{Fore.LIGHTYELLOW_EX}Creating new version of '{package_name}'...{Style.RESET_ALL}")
+            package_file_path = os.path.join(build_dir, package_file_name)
+            with self.tracer.span("build", package_name, compression=compression) as span:
+                index_sha256 = _build_archive(source_dir, package_file_path, compression)
+                sha256 = _sha256_file(package_file_path)
+                span.set(size=os.path.getsize(package_file_path))
+
+            with self.tracer.span("compare", package_name) as span:
+                published = self.registry.release(package_name, package_version)
+                if published is not None and published["version"] == package_version:
+                    published_sha256 = published["sha256"]
+                else:
+                    # Not in the registry index (uploaded before it existed): ask the object itself.
+                    published_sha256 = (self.storage.metadata(f"{blob_dir}/{package_file_name}") or {}).get("sha256")
+                span.set(unchanged=published_sha256 == sha256)
+            if published_sha256 == sha256:
+                print(f"{Fore.YELLOW}Package '{package_name}' {package_version} is already uploaded.{Style.RESET_ALL}")
+                return False
+
+            print(f"{Fore.LIGHTYELLOW_EX}Uploading new version...{Style.RESET_ALL}")
+            with self.tracer.span("upload", package_name,
+                                  bytes=os.path.getsize(package_file_path)), \
+                    _thread_pool(2) as pool:
+                uploads = [pool.submit(self.storage.upload_file, f"{blob_dir}/{package_file_name}", package_file_path,
+                                       {"sha256": sha256}),
+                           pool.submit(self.storage.upload_file, f"{blob_dir}/package.json",
+                                       os.path.join(source_dir, "package.json"))]
+                for future in uploads:
+                    future.result()
+            with self.tracer.span("publish", package_name):
+                self.registry.publish(package_name, package_version, package_file_path,
+                                      f"{blob_dir}/{package_file_name}", package_info.get("dependencies", {}), sha256,
+                                      index_sha256)
+        print(
+            f"\n      {Back.LIGHTGREEN_EX}{Fore.LIGHTWHITE_EX}      Package '{package_name}' uploaded successfully!      {Style.RESET_ALL}\n")
+        return True
 
     def upgrade_package(self, *packages, **kwargs):
-        self.install_package(*packages, **kwargs)
+        return self.install_package(*packages, upgrade=True, **kwargs)
 
-    def get_package_info(self, package_name):
-        return self._fetch_package_info(package_name)
+    def outdated_packages(self):
+        outdated = {}
+        for package_name in self.get_installed_packages():
+            installed_version = self._installed_version(package_name)
+            latest_version = self.registry.latest(package_name)
+            if installed_version and latest_version and _version_key(latest_version) > _version_key(installed_version):
+                outdated[package_name] = (installed_version, latest_version)
+        return outdated
 
-    def _fetch_package_info(self, package_name):
-        print(f"Fetching package '{package_name}'...\n")
+    def _installed_version(self, package_name):
+        entry = self.state.get(package_name)
+        if entry is not None:
+            return entry["version"]
         try:
-            # Authenticate the user with appropriate credentials
-            # cred = credentials.Certificate(__cert_path__)
-            # firebase_admin.initialize_app(cred, {'storageBucket': __storage_bucket__})
+            with open(os.path.join(self.installed_packages_dir, package_name, "package.json")) as file:
+                return json.load(file)["version"].replace("_", ".")
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def get_package_info(self, package_name):
+        return self.get_packages_info([package_name])[0].get(package_name)
+
+    def get_packages_info(self, package_specs, jobs=None):
+        # Returns ({spec: package.json or None}, {spec: error}) for `name` / `name@range` specs. Versions come from
+        # the registry index, cached documents are reused, and the rest are fetched concurrently on a bounded pool.
+        # Only "not found" is cached as a miss; other errors are reported and retried on the next call.
+        import concurrent.futures
 
-            # Access the package.json file from Firebase Storage
-            bucket = storage.bucket()
-            blob = bucket.blob(f"packages/{package_name}/1_0_0/package.json")
-            package_info = blob.download_as_text()
-            package_info = json.loads(package_info)
+        wanted = {}
+        failures = {}
+        for package_spec in package_specs:
+            package_name, package_range = _split_spec(package_spec)
+            try:
+                release = self.registry.release(package_name, package_range)
+            except Exception as e:
+                print(f"{Fore.RED}Error fetching '{package_name}': {e}{Style.RESET_ALL}", file=sys.stderr)
+                failures[package_spec] = e
+                continue
+            wanted[package_spec] = (package_name, release["version"] if release else package_range)
 
-            return package_info
+        infos = {}
+        for package_name, package_version in set(wanted.values()):
+            found, package_info = self.metadata.get(f"{package_name}@{package_version or ''}")
+            if found:
+                infos[package_name, package_version] = package_info
+
+        def fetch(package_name, package_version):
+            with self.tracer.span("info", package_name):
+                return self._read_package_info(package_name, package_version)
+
+        fetched = {}
+        missing = set(wanted.values()) - set(infos)
+        if missing:
+            # Metadata requests are small and latency-bound, so more of them run at once than downloads do.
+            with _thread_pool(min(jobs or 4 * self.jobs, len(missing))) as pool:
+                futures = {pool.submit(fetch, *key): key for key in missing}
+                for future in concurrent.futures.as_completed(futures):
+                    package_name, package_version = futures[future]
+                    try:
+                        fetched[package_name, package_version] = future.result()
+                    except Exception as e:
+                        print(f"{Fore.RED}Error fetching '{package_name}': {e}{Style.RESET_ALL}", file=sys.stderr)
+                        infos[package_name, package_version] = e
+            self.metadata.put_many({f"{package_name}@{package_version or ''}": package_info
+                                    for (package_name, package_version), package_info in fetched.items()})
+        infos.update(fetched)
+        for package_spec, key in wanted.items():
+            if isinstance(infos[key], Exception):
+                failures[package_spec] = infos[key]
+        return ({package_spec: infos[key] for package_spec, key in wanted.items() if package_spec not in failures},
+                failures)
+
+    def _fetch_package_info(self, package_name, package_version=None):
+        try:
+            return self._read_package_info(package_name, package_version)
         except Exception as e:
             print(f"{Fore.RED}Error: {e}{Style.RESET_ALL}")
 
+    def _read_package_info(self, package_name, package_version=None):
+        # The registry index knows the latest version; packages it doesn't list predate it and live at 1.0.0.
+        package_version = package_version or self.registry.latest(package_name) or "1.0.0"
+        try:
+            # Access the package.json file from the registry storage
+            package_info, _ = self.storage.read(f"packages/{package_name}/{package_version.replace('.', '_')}/package.json")
+        except StorageNotFound:
+            return None
+        return json.loads(package_info)
+
+    def manage_cache(self, action):
+        if action == "ls":
+            entries = self.cache.entries()
+            total = sum({entry["sha256"]: entry["size"] for entry in entries.values()}.values())
+            for key, entry in sorted(entries.items()):
+                last_used = datetime.datetime.fromtimestamp(entry["last_used"]).strftime("%Y-%m-%d %H:%M:%S")
+                print(f"{Fore.LIGHTWHITE_EX}{key}{Style.RESET_ALL}  {entry['size']} bytes  "
+                      f"sha256:{entry['sha256'][:12]}  last used {last_used}")
+            print(f"\n{len(entries)} package(s), {total} of {self.cache.max_size} bytes in {self.cache.root}")
+        elif action == "prune":
+            removed = self.cache.prune()
+            for key in removed:
+                print(f"{Fore.YELLOW}Evicted '{key}'.{Style.RESET_ALL}")
+            print(f"{len(removed)} package(s) evicted from the cache.")
+        elif action == "verify":
+            corrupt = self.cache.verify()
+            for key in corrupt:
+                print(f"{Fore.RED}Corrupt archive for '{key}' removed.{Style.RESET_ALL}")
+            if corrupt:
+                return False
+            print(f"{Fore.YELLOW}All cached archives verified.{Style.RESET_ALL}")
+        else:
+            print(f"{Fore.RED}Error: unknown cache command '{action}' (expected ls, prune or verify).{Style.RESET_ALL}")
+            return False
+        return True
+
+    def manage_store(self, action):
+        if action == "ls":
+            entries = self.store.entries()
+            for name, manifest in entries.items():
+                size = sum(recorded["size"] for recorded in manifest["files"].values())
+                print(f"{Fore.LIGHTWHITE_EX}{name}{Style.RESET_ALL}  {len(manifest['files'])} file(s)  {size} bytes")
+            print(f"\n{len(entries)} package(s) in {self.store.root}, "
+                  f"linked by {len(self.store.workspaces())} workspace(s)")
+        elif action == "gc":
+            removed = self.store.gc()
+            for name in removed:
+                print(f"{Fore.YELLOW}Removed '{name}'.{Style.RESET_ALL}")
+            print(f"{len(removed)} package(s) removed from the store.")
+        elif action == "verify":
+            corrupt = self.store.verify()
+            for name in corrupt:
+                print(f"{Fore.RED}Corrupt store entry '{name}' removed.{Style.RESET_ALL}")
+            if corrupt:
+                return False
+            print(f"{Fore.YELLOW}All store entries verified.{Style.RESET_ALL}")
+        else:
+            print(f"{Fore.RED}Error: unknown store command '{action}' (expected ls, gc or verify).{Style.RESET_ALL}")
+            return False
+        return True
+
+    def which(self, *symbols):
+        # Returns {symbol: definitions} from the symbol index, brought up to date with the installed state first.
+        self.symbols.update(self.state.packages())
+        return {symbol: self.symbols.lookup(symbol) for symbol in symbols}
+
     def get_installed_packages(self):
-        return os.listdir(self.package_dir)
+        return sorted(self.state.packages())
 
     def get_installed_package_info(self, package_name):
-        if package_name in self.get_installed_packages():
-            with open(os.path.join(self.package_dir, package_name, "package.json")) as file:
-                package_info = file.read()
-            return json.loads(package_info)
-        else:
+        entry = self.state.get(package_name)
+        if entry is not None:
+            return dict(entry, name=package_name)
+        # Installed before the state file existed: fall back to the package's own package.json.
+        try:
+            with open(os.path.join(self.installed_packages_dir, package_name, "package.json")) as file:
+                return json.load(file)
+        except (OSError, ValueError):
             return None
 
+    def verify_packages(self, *packages):
+        clean = True
+        for package_name in packages or self.get_installed_packages():
+            if self.state.get(package_name) is None:
+                print(f"{Fore.RED}Package '{package_name}' is not installed.{Style.RESET_ALL}")
+                clean = False
+                continue
+            missing, modified, unexpected = self.state.verify(package_name)
+            for label, paths in (("missing", missing), ("modified", modified), ("unexpected", unexpected)):
+                for path in paths:
+                    print(f"{Fore.RED}{package_name}: {label} {path}{Style.RESET_ALL}")
+            if missing or modified or unexpected:
+                clean = False
+            else:
+                print(f"{Fore.YELLOW}{package_name}: OK{Style.RESET_ALL}")
+        return clean
+
     def _download_file(self, url, file_path):
+        import requests
+
         try:
             response = requests.get(url, stream=True)
             if response.status_code == 200:
@@ -280,7 +3072,421 @@ class ProtoCSSPackageManager:
             print(f"{Fore.RED}Error: {e}{Style.RESET_ALL}")
 
 
-def main():
+def _registry_handler(storage, token):
+    # Request handler for `ptm serve-registry`, built lazily so http.server is only imported by that command. GET
+    # and HEAD support Range and If-None-Match, PUT supports If-Match / If-None-Match: * so concurrent uploads can
+    # update the index safely. When REGISTRY_TOKEN is set, PUT requires it as a bearer token.
+    import http.server
+    import urllib.parse
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            print(f"{Fore.LIGHTBLACK_EX}{self.address_string()} {format % args}{Style.RESET_ALL}")
+
+        def _object(self):
+            path = urllib.parse.unquote(self.path.split("?", 1)[0]).lstrip("/")
+            if not path or path.endswith(".meta.json"):
+                return None, None
+            try:
+                return path, storage.tag(path)
+            except ValueError:
+                return None, None
+
+        def _send_metadata(self, path):
+            for key, value in (storage.metadata(path) or {}).items():
+                self.send_header(f"X-Ptm-Meta-{key}", str(value))
+
+        def do_HEAD(self):
+            self.do_GET(body=False)
+
+        def do_GET(self, body=True):
+            path, tag = self._object()
+            if tag is None:
+                self.send_error(404)
+                return
+            etag = f'"{tag}"'
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            file_path = storage._path(path)
+            size = os.path.getsize(file_path)
+            begin, end = 0, size
+            match = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+            if match and int(match.group(1)) < size:
+                begin = int(match.group(1))
+                end = min(int(match.group(2)) + 1, size) if match.group(2) else size
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {begin}-{end - 1}/{size}")
+            else:
+                self.send_response(200)
+            self.send_header("Content-Length", str(end - begin))
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", etag)
+            self._send_metadata(path)
+            self.end_headers()
+            if not body:
+                return
+            with open(file_path, "rb") as file:
+                file.seek(begin)
+                remaining = end - begin
+                while remaining:
+                    chunk = file.read(min(_MAX_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    remaining -= len(chunk)
+
+        def do_PUT(self):
+            if token and self.headers.get("Authorization") != f"Bearer {token}":
+                self.send_error(401)
+                return
+            path, tag = self._object()
+            if path is None:
+                self.send_error(400)
+                return
+            if_match = None
+            if self.headers.get("If-None-Match") == "*":
+                if_match = ""
+            elif self.headers.get("If-Match"):
+                if_match = self.headers["If-Match"].strip('"')
+            metadata = {key[len("X-Ptm-Meta-"):].lower(): value for key, value in self.headers.items()
+                        if key.lower().startswith("x-ptm-meta-")}
+            data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            try:
+                storage.write(path, data, metadata=metadata or None, if_match=if_match)
+            except StorageConflict:
+                self.send_error(412)
+                return
+            self.send_response(201)
+            self.send_header("ETag", f'"{storage.tag(path)}"')
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+    return Handler
+
+
+def serve_registry(root, host="127.0.0.1", port=8080):
+    import http.server
+
+    storage = LocalBackend(root)
+    os.makedirs(storage.root, exist_ok=True)
+    handler = _registry_handler(storage, _config("REGISTRY_TOKEN"))
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    print(f"{Fore.LIGHTGREEN_EX}Serving registry {storage.root} on http://{host}:{server.server_address[1]}"
+          f"{Style.RESET_ALL}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def _daemon_socket_path():
+    return _config("DAEMON_SOCKET") or os.path.join(
+        _config("CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "ptm")), "daemon.sock")
+
+
+def _daemon_config():
+    # The settings a command runs with. The daemon only serves clients whose settings match its own; the others
+    # run the command themselves. Paths in .env are relative to its directory, so that has to match too.
+    return {
+        "dotenv_dir": os.getcwd() if os.path.exists(".env") else None,
+        "env": {key: value for key, value in os.environ.items()
+                if key.startswith("PTM_") and key not in ("PTM_DAEMON_SOCKET", "PTM_NO_DAEMON")},
+        "dotenv": {key: value for key, value in _load_config().items() if key not in ("DAEMON_SOCKET", "NO_DAEMON")},
+    }
+
+
+class _DaemonClient:
+    # The connection of one `ptm daemon` request. Output is sent back as JSON lines ({"stdout": text},
+    # {"stderr": text}), followed by {"exit": status}.
+    def __init__(self, stream):
+        self._stream = stream
+        self._lock = threading.Lock()
+
+    def send(self, message):
+        with self._lock:
+            try:
+                self._stream.write(json.dumps(message).encode() + b"\n")
+                self._stream.flush()
+            except OSError:
+                pass  # The client went away; the command still runs to completion.
+
+
+class _ClientOutput:
+    # One output stream of a `ptm daemon` client. Streams of the same client compare equal, which is how tqdm tells
+    # which progress bars to clear before printing a message.
+    encoding = "utf-8"
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def write(self, text):
+        self.client.send({self.name: text})
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+    def __eq__(self, other):
+        return isinstance(other, _ClientOutput) and other.client is self.client
+
+    def __hash__(self):
+        return id(self.client)
+
+
+class _RoutedOutput:
+    # Replaces sys.stdout / sys.stderr in `ptm daemon`: text goes to the client of the request running in the
+    # current context, or to the daemon's own stream outside of requests.
+    encoding = "utf-8"
+
+    def __init__(self, name, fallback):
+        self.name = name
+        self.fallback = fallback
+
+    def write(self, text):
+        client = _output.get()
+        if client is None:
+            return self.fallback.write(text)
+        return _ClientOutput(client, self.name).write(text)
+
+    def flush(self):
+        if _output.get() is None:
+            self.fallback.flush()
+
+    def isatty(self):
+        return False
+
+
+class _Daemon:
+    # State kept warm by `ptm daemon`: one manager per registry and cache size, holding the storage client,
+    # connection pool, registry index and metadata cache. Each request runs on a copy of it for its own project
+    # directory.
+    def __init__(self):
+        self.config = _daemon_config()
+        self._managers = {}
+        self._lock = threading.Lock()
+
+    def manager(self, args, cwd):
+        key = (args.registry or "", args.cache_size)
+        with self._lock:
+            if key not in self._managers:
+                self._managers[key] = ProtoCSSPackageManager(args.registry or "", cache_size=args.cache_size)
+            shared = self._managers[key]
+        shared.registry.expire()
+        return shared.for_project(cwd, jobs=args.jobs, tracer=_tracer(args), link_mode=args.link)
+
+    def run(self, argv, cwd):
+        try:
+            args = _argument_parser().parse_args(argv)
+            for name in ("trace_json", "names_from", "registry"):
+                value = getattr(args, name)
+                if value not in (None, "-") and "://" not in value:
+                    setattr(args, name, os.path.join(cwd, value))
+            _execute(self.manager(args, cwd), args, argv)
+        except SystemExit as e:
+            return e.code if isinstance(e.code, int) else int(e.code is not None)
+        except Exception:
+            import traceback
+
+            traceback.print_exc()
+            return 1
+        return 0
+
+
+def _daemon_handler(daemon):
+    import socketserver
+
+    class DaemonHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            try:
+                request = json.loads(self.rfile.readline())
+            except ValueError:
+                return
+            client = _DaemonClient(self.wfile)
+            if request.get("config") != daemon.config:
+                client.send({"fallback": "settings differ from the daemon's"})
+                return
+            token = _output.set(client)
+            try:
+                status = daemon.run(request["argv"], request["cwd"])
+            finally:
+                _output.reset(token)
+            client.send({"exit": status})
+
+    return DaemonHandler
+
+
+def _connect_daemon(socket_path):
+    import socket
+
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+    except OSError:
+        connection.close()
+        return None
+    return connection
+
+
+def serve_daemon(socket_path=None):
+    import signal
+    import socketserver
+    from tqdm import tqdm
+
+    socket_path = socket_path or _daemon_socket_path()
+    if os.path.exists(socket_path):
+        connection = _connect_daemon(socket_path)
+        if connection is not None:
+            connection.close()
+            print(f"{Fore.RED}Error: a ptm daemon is already listening on {socket_path}.{Style.RESET_ALL}")
+            sys.exit(1)
+        os.remove(socket_path)  # Left behind by a daemon that was killed.
+    os.makedirs(os.path.dirname(os.path.abspath(socket_path)), exist_ok=True)
+
+    daemon = _Daemon()
+    sys.stdout = _RoutedOutput("stdout", sys.stdout)
+    sys.stderr = _RoutedOutput("stderr", sys.stderr)
+    # tqdm's monitor thread would refresh progress bars outside of any request.
+    tqdm.monitor_interval = 0
+    server = socketserver.ThreadingUnixStreamServer(socket_path, _daemon_handler(daemon))
+    server.daemon_threads = True
+    os.chmod(socket_path, 0o600)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print(f"{Fore.LIGHTGREEN_EX}ptm daemon listening on {socket_path}{Style.RESET_ALL}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        _remove_quietly(socket_path)
+
+
+def _forward_to_daemon(argv):
+    # Runs the command in `ptm daemon` when one is listening. Returns its exit status, or None when there is no
+    # daemon or it asks the client to run the command itself.
+    socket_path = _daemon_socket_path()
+    if not os.path.exists(socket_path) or _config("NO_DAEMON"):
+        return None
+    connection = _connect_daemon(socket_path)
+    if connection is None:
+        return None
+    with connection, connection.makefile("rwb") as stream:
+        stream.write(json.dumps({"argv": argv, "cwd": os.getcwd(), "config": _daemon_config()}).encode() + b"\n")
+        stream.flush()
+        for line in stream:
+            message = json.loads(line)
+            if "fallback" in message:
+                return None
+            if "exit" in message:
+                return message["exit"]
+            for name, output in (("stdout", sys.stdout), ("stderr", sys.stderr)):
+                if name in message:
+                    output.write(message[name])
+                    output.flush()
+    print(f"{Fore.RED}Error: the ptm daemon closed the connection.{Style.RESET_ALL}", file=sys.stderr)
+    return 1
+
+
+def _subcommand(args):
+    # `ptm cache ls`, `ptm list`, ... The first name is only a subcommand when no action flag is given, so
+    # `ptm -i cache` still installs a package called `cache`.
+    if args.install or args.upgrade or args.get_info or args.get_info_web or args.upload or args.outdated:
+        return None
+    if args.packages[:1] and args.packages[0] in ("cache", "store", "list", "which", "verify", "serve-registry",
+                                                  "daemon"):
+        return args.packages[0]
+    return None
+
+
+def _run_command(ptm, args):
+    command = _subcommand(args)
+    if command == "cache":
+        if not ptm.manage_cache(args.packages[1] if len(args.packages) > 1 else "ls"):
+            sys.exit(1)
+    elif command == "store":
+        if not ptm.manage_store(args.packages[1] if len(args.packages) > 1 else "ls"):
+            sys.exit(1)
+    elif command == "list":
+        for package_name, entry in sorted(ptm.state.packages().items()):
+            print(f"{Fore.LIGHTWHITE_EX}{package_name}{Style.RESET_ALL} {entry['version']}")
+    elif command == "which":
+        definitions = ptm.which(*args.packages[1:])
+        if args.json:
+            print(json.dumps(definitions, indent=4))
+        else:
+            for symbol, found in definitions.items():
+                if not found:
+                    print(f"{Fore.RED}'{symbol}' is not defined by any installed package.{Style.RESET_ALL}")
+                for definition in found:
+                    print(f"{Fore.LIGHTWHITE_EX}{symbol}{Style.RESET_ALL} {definition['package']} "
+                          f"{definition['file']}:{definition['offset']} ({definition['kind']})")
+        if not all(definitions.values()):
+            sys.exit(1)
+    elif command == "verify":
+        if not ptm.verify_packages(*args.packages[1:]):
+            sys.exit(1)
+    elif args.install:
+        if ptm.install_package(*args.packages, only=args.only):
+            sys.exit(1)
+    elif args.upgrade:
+        if ptm.upgrade_package(*args.packages):
+            sys.exit(1)
+    elif args.outdated:
+        outdated = ptm.outdated_packages()
+        for package_name, (installed_version, latest_version) in sorted(outdated.items()):
+            print(f"{Fore.LIGHTWHITE_EX}{package_name}:{Style.RESET_ALL} {installed_version} -> {latest_version}")
+        if not outdated:
+            print(f"{Fore.YELLOW}All packages are up to date.{Style.RESET_ALL}")
+    elif args.get_info:
+        for package_name in args.packages:
+            package_info = ptm.get_installed_package_info(package_name)
+            if package_info is None:
+                print(f"{Fore.RED}Error: module '{package_name}' does not exist in the modules directory.{Style.RESET_ALL}")
+                continue
+            print(f"\n{Fore.LIGHTWHITE_EX}Package name:{Style.RESET_ALL} {package_name}")
+            print(f"{Fore.LIGHTWHITE_EX}Version:{Style.RESET_ALL} {package_info['version'].replace('_', '.')}")
+            print(f"{Fore.LIGHTWHITE_EX}Author:{Style.RESET_ALL} {package_info.get('author', '')}")
+            print(f"{Fore.LIGHTWHITE_EX}Description:{Style.RESET_ALL} {package_info.get('description', '')}")
+            if "files" in package_info:
+                print(f"{Fore.LIGHTWHITE_EX}Files:{Style.RESET_ALL} {', '.join(sorted(package_info['files']))}")
+            print()
+    elif args.get_info_web:
+        package_specs = list(args.packages)
+        if args.names_from:
+            with (sys.stdin if args.names_from == "-" else open(args.names_from)) as file:
+                package_specs += [line.strip() for line in file if line.strip() and not line.startswith("#")]
+        infos, failures = ptm.get_packages_info(list(dict.fromkeys(package_specs)))
+        if args.json:
+            print(json.dumps(infos, indent=4))
+        else:
+            for package_name, package_info in infos.items():
+                if package_info is not None:
+                    print(f"{Fore.LIGHTWHITE_EX}Package name:{Style.RESET_ALL} {package_name}")
+                    print(f"{Fore.LIGHTWHITE_EX}Version:{Style.RESET_ALL} {package_info['version'].replace('_', '.')}")
+                    print(f"{Fore.LIGHTWHITE_EX}Author:{Style.RESET_ALL} {package_info.get('author', '')}")
+                    print(f"{Fore.LIGHTWHITE_EX}Description:{Style.RESET_ALL} {package_info.get('description', '')}\n")
+                else:
+                    print(f"Package '{package_name}' not found.")
+        if failures:
+            sys.exit(1)
+    elif args.upload:
+        if ptm.upload_package(*args.packages, compression=args.compression):
+            sys.exit(1)
+
+
+
+def _argument_parser():
     parser = argparse.ArgumentParser(prog="ptm", description="ProtoCSS Package Manager")
     parser.add_argument("packages", nargs="*", help="Package names")
     parser.add_argument("-i", "--install", action="store_true", help="Install packages")
@@ -288,49 +3494,73 @@ def main():
     parser.add_argument("-gic", "--get-info-web", action="store_true", help="Get package information from the cloud")
     parser.add_argument("-gi", "--get-info", action="store_true", help="Get installed package information")
     parser.add_argument("-up", "--upload", action="store_true", help="Upload a package")
+    parser.add_argument("-o", "--outdated", action="store_true", help="List installed packages with newer versions")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="Number of packages to download and extract in parallel (default: CPU count)")
+    parser.add_argument("--cache-size", help="Maximum size of the package cache, e.g. 500M or 2G (0 disables it)")
+    parser.add_argument("--registry", help="Registry URL or directory (default: REGISTRY_URL, else Firebase)")
+    parser.add_argument("--host", default="127.0.0.1", help="Address for `ptm serve-registry` to listen on")
+    parser.add_argument("--port", type=int, default=8080, help="Port for `ptm serve-registry` to listen on")
+    parser.add_argument("--profile", action="store_true", help="Print time spent per package and phase")
+    parser.add_argument("--trace-json", metavar="FILE", help="Write timing spans per package and phase to FILE")
+    parser.add_argument("--names-from", metavar="FILE", help="Read more package names for -gic from FILE (- for stdin)")
+    parser.add_argument("--json", action="store_true", help="Print -gic and `ptm which` results as JSON")
+    parser.add_argument("--only", metavar="GLOB", action="append",
+                        help="Install only the matching files of the named packages (repeatable)")
+    parser.add_argument("--compression", choices=("zip",) + _PTM2_COMPRESSIONS,
+                        help="Package format for -up: zip, or a PTM2 package compressed with zlib, xz or zstd")
+    parser.add_argument("--link", choices=("none", "auto", "hardlink", "reflink", "symlink", "copy"),
+                        help="Install through the shared content store, linking packages into modules/ "
+                             "(default: LINK_MODE, else none)")
+    parser.add_argument("--no-daemon", action="store_true", help="Run the command here even if `ptm daemon` is running")
+    return parser
 
-    args = parser.parse_args()
 
-    server_url = ""
-    ptm = ProtoCSSPackageManager(server_url)
-    ptm.initialize()
+def _tracer(args):
+    tracer = Tracer(enabled=args.profile or bool(args.trace_json))
+    if _config("TRACE_HOOK"):
+        tracer.add_hook(_load_trace_hook(_config("TRACE_HOOK")))
+    return tracer
 
-    if args.install:
-        ptm.install_package(*args.packages)
-    elif args.upgrade:
-        ptm.upgrade_package(*args.packages)
-    elif args.get_info:
-        try:
-            for package_name in args.packages:
-                for file in os.listdir(os.path.join(os.path.abspath("modules"), package_name)):
-                    if file == "package.json":
-                        with open(os.path.join(os.path.join(os.path.abspath("modules")), package_name,
-                                               file)) as package_file:
-                            package_info = json.load(package_file)
-                            print(f"\n{Fore.LIGHTWHITE_EX}Package name:{Style.RESET_ALL} {package_name}")
-                            print(
-                                f"{Fore.LIGHTWHITE_EX}Version:{Style.RESET_ALL} {package_info['version'].replace('_', '.')}")
-                            print(f"{Fore.LIGHTWHITE_EX}Author:{Style.RESET_ALL} {package_info['author']}")
-                            print(f"{Fore.LIGHTWHITE_EX}Description:{Style.RESET_ALL} {package_info['description']}\n")
-                        break
-        except Exception as e:
-            print(f"{Fore.RED}Error: module '{package_name}' does not exist in the modules directory.{Style.RESET_ALL}")
-    elif args.get_info_web:
-        for package_name in args.packages:
-            package_info = ptm.get_package_info(package_name)
-            if package_info is not None:
-                print(f"{Fore.LIGHTWHITE_EX}Package name:{Style.RESET_ALL} {package_name}")
-                print(f"{Fore.LIGHTWHITE_EX}Version:{Style.RESET_ALL} {package_info['version'].replace('_', '.')}")
-                print(f"{Fore.LIGHTWHITE_EX}Author:{Style.RESET_ALL} {package_info['author']}")
-                print(f"{Fore.LIGHTWHITE_EX}Description:{Style.RESET_ALL} {package_info['description']}\n")
-            else:
-                print(f"Package '{package_name}' not found.")
-    elif args.upload:
-        for package_name in args.packages:
-            if package_name in os.listdir(ptm.package_dir):
-                ptm.upload_package()
-            else:
-                print(f"Package '{package_name}' not found.")
+
+def _execute(ptm, args, argv):
+    # Registry setup and storage failures (no .env, an unreachable registry) end the command with their message
+    # rather than a traceback.
+    try:
+        ptm.initialize()
+        _run_command(ptm, args)
+    except (RuntimeError, OSError, StorageNotFound, StorageConflict) as e:
+        print(f"{Fore.RED}Error: {e}{Style.RESET_ALL}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        if args.trace_json:
+            ptm.tracer.to_json(args.trace_json, argv)
+        if args.profile:
+            print(ptm.tracer.summary())
+
+
+def _forwardable(args):
+    # Uploads may prompt for package.json fields and `--names-from -` reads stdin, so they always run here.
+    return os.name == "posix" and not args.no_daemon and not args.upload and args.names_from != "-"
+
+
+def main():
+    args = _argument_parser().parse_args()
+
+    if _subcommand(args) == "serve-registry":
+        serve_registry(args.packages[1] if len(args.packages) > 1 else "registry", args.host, args.port)
+        return
+    if _subcommand(args) == "daemon":
+        serve_daemon(args.packages[1] if len(args.packages) > 1 else None)
+        return
+    if _forwardable(args):
+        status = _forward_to_daemon(sys.argv[1:])
+        if status is not None:
+            sys.exit(status)
+
+    ptm = ProtoCSSPackageManager(args.registry or "", jobs=args.jobs, cache_size=args.cache_size, tracer=_tracer(args),
+                                 link_mode=args.link)
+    _execute(ptm, args, sys.argv[1:])
 
 
 if __name__ == "__main__":
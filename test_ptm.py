@@ -0,0 +1,75 @@
+import unittest
+
+from ptm import _latest_version, _satisfies, _version_key
+
+
+class VersionOrderTest(unittest.TestCase):
+    def test_semver_precedence(self):
+        versions = ["1.0.0-alpha", "1.0.0-alpha.1", "1.0.0-alpha.beta", "1.0.0-beta", "1.0.0-beta.2",
+                    "1.0.0-beta.11", "1.0.0-rc.1", "1.0.0", "1.0.1", "1.10.0", "2.0.0"]
+        self.assertEqual(sorted(reversed(versions), key=_version_key), versions)
+
+    def test_build_metadata_is_ignored(self):
+        self.assertEqual(_version_key("1.2.3+build.5"), _version_key("1.2.3"))
+
+    def test_latest_prefers_releases(self):
+        self.assertEqual(_latest_version(["1.1.0", "1.2.0-beta", "1.0.0"]), "1.1.0")
+        self.assertEqual(_latest_version(["2.0.0-rc.1", "2.0.0-rc.2"]), "2.0.0-rc.2")
+
+
+class RangeTest(unittest.TestCase):
+    def assertRange(self, package_range, matching, not_matching):
+        for version in matching:
+            self.assertTrue(_satisfies(version, package_range), f"{version} should satisfy {package_range}")
+        for version in not_matching:
+            self.assertFalse(_satisfies(version, package_range), f"{version} should not satisfy {package_range}")
+
+    def test_exact_and_any(self):
+        self.assertRange("1.2.3", ["1.2.3"], ["1.2.4", "1.2.3-rc.1"])
+        self.assertRange("=1.2.3", ["1.2.3"], ["1.2.2"])
+        self.assertRange("*", ["0.0.1", "3.4.5"], ["3.4.5-beta"])
+        self.assertRange("", ["1.0.0"], [])
+
+    def test_x_ranges(self):
+        self.assertRange("1.x", ["1.0.0", "1.9.9"], ["2.0.0", "0.9.9"])
+        self.assertRange("1.2", ["1.2.0", "1.2.9"], ["1.3.0", "1.1.9"])
+        self.assertRange("1", ["1.0.0", "1.5.0"], ["2.0.0"])
+
+    def test_caret(self):
+        self.assertRange("^1.2.3", ["1.2.3", "1.9.0"], ["1.2.2", "2.0.0", "2.0.0-rc1"])
+        self.assertRange("^0.2.3", ["0.2.3", "0.2.9"], ["0.3.0"])
+        self.assertRange("^0.0.3", ["0.0.3"], ["0.0.4"])
+        self.assertRange("^1.2", ["1.2.0", "1.9.9"], ["2.0.0", "1.1.0"])
+
+    def test_tilde(self):
+        self.assertRange("~1.2.3", ["1.2.3", "1.2.9"], ["1.3.0", "1.2.2"])
+        self.assertRange("~1.2", ["1.2.0", "1.2.9"], ["1.3.0"])
+        self.assertRange("~1", ["1.0.0", "1.9.0"], ["2.0.0"])
+
+    def test_comparators(self):
+        self.assertRange(">=1.2.3", ["1.2.3", "2.0.0"], ["1.2.2"])
+        self.assertRange(">1.2.3", ["1.2.4"], ["1.2.3"])
+        self.assertRange("<=1.2.3", ["1.2.3", "1.0.0"], ["1.2.4"])
+        self.assertRange("<1.2.3", ["1.2.2"], ["1.2.3"])
+        self.assertRange(">=1.2 <2", ["1.2.0", "1.9.9"], ["1.1.9", "2.0.0"])
+
+    def test_partial_comparators(self):
+        self.assertRange("<=1.2", ["1.2.0", "1.2.3", "1.2.5"], ["1.3.0", "1.3.0-rc.1"])
+        self.assertRange("<=1", ["1.9.9"], ["2.0.0"])
+        self.assertRange(">1.2", ["1.3.0"], ["1.2.0", "1.2.9"])
+        self.assertRange(">1", ["2.0.0"], ["1.0.1", "1.9.9"])
+        self.assertRange("<1.2", ["1.1.9"], ["1.2.0", "1.2.1"])
+        self.assertRange(">=1.2", ["1.2.0"], ["1.1.9"])
+
+    def test_alternatives(self):
+        self.assertRange("^1.0.0 || ^3.0.0", ["1.5.0", "3.1.0"], ["2.0.0"])
+
+    def test_prereleases(self):
+        self.assertRange(">=1.2.0-alpha", ["1.2.0-beta", "1.2.0", "1.3.0"], ["1.3.0-beta"])
+        self.assertRange("^1.1", ["1.1.0"], ["1.2.0-beta"])
+        self.assertRange("1.2.0-beta", ["1.2.0-beta"], ["1.2.0-alpha", "1.2.0"])
+        self.assertRange(">=1.2.0-alpha <1.2", [], ["1.2.0-beta"])
+
+
+if __name__ == "__main__":
+    unittest.main()